@@ -8,7 +8,9 @@ from djangotoolbox import fields as tb_fields
 from inflector.inflector import Inflector
 from json_field import JSONField, fields as json_fields
 
-from denorm import core, receivers, util
+from denorm import core, fields as denorm_fields, metrics, receivers, util
+from denorm.propagation import propagate
+from denorm.source_cache import prefetch_sources
 
 def autodiscover():
     auto_discover('denorm_fields')
@@ -49,6 +51,126 @@ def _copy_field(field, field_name, owner_model_name):
 
     return clone
 
+def _compile_target_plan(target_model):
+
+    sources = []
+    orig_source_attnames = []
+
+    for source, target_data in core.TARGET_GRAPH[target_model].iteritems():
+
+        storage = target_data['storage']
+        fields = tuple(target_data['fields'])
+
+        if storage == 'scalar':
+            attname = source + '_id'
+            list_field_name = None
+            orig_source_attnames.append((source, attname))
+        else:
+            attname = None
+            list_field_name = Inflector().pluralize(source)
+            orig_source_attnames.append((list_field_name, list_field_name))
+
+        sources.append(core.TargetSourcePlan(
+            source=source,
+            storage=storage,
+            source_model=target_data['source_model'],
+            attname=attname,
+            list_field_name=list_field_name,
+            field_names=fields,
+            target_field_names=tuple((field, '%s_%s' % (source, field)) for field in fields)
+        ))
+
+    core.TARGET_PLANS[target_model] = core.TargetPlan(
+        model_name=util.get_model_name(target_model),
+        sources=tuple(sources),
+        orig_source_attnames=tuple(orig_source_attnames)
+    )
+
+def _compile_source_plan(source_model):
+
+    source_graph = core.SOURCE_GRAPH[source_model]
+    fields = []
+
+    for source_field, targets in source_graph['fields'].iteritems():
+        fields.append((source_field, tuple(
+            core.SourceTargetPlan(
+                target_model=target['target_model'],
+                target_model_name=util.get_model_name(target['target_model']),
+                source=target['source'],
+                strategy=target['strategy'],
+                storage=target['storage'],
+                shards=target['shards'],
+                min_page_size=target.get('min_page_size'),
+                max_page_size=target.get('max_page_size'),
+                lane=target.get('lane'),
+                target_field_name='%s_%s' % (target['source'], source_field),
+                chained=target['storage'] == 'scalar' and
+                        '%s_%s' % (target['source'], source_field) in core.SOURCE_GRAPH.get(target['target_model'], {}).get('fields', {})
+            ) for target in targets
+        )))
+
+    core.SOURCE_PLANS[source_model] = core.SourcePlan(
+        model_name=util.get_model_name(source_model),
+        label=source_graph.get('label'),
+        throttles=tuple(source_graph.get('throttles') or ()),
+        fields=tuple(fields),
+        field_names=tuple(source_field for source_field, targets in fields),
+        orig_value_attnames=tuple((source_field, source_field) for source_field, targets in fields)
+    )
+
+def _connect_target_receivers(target_model, target):
+
+    db_signals.post_init.connect(receivers.target_model_post_init, sender=target_model, dispatch_uid='denorm_target_%s_post_init'%target)
+    db_signals.pre_save.connect(receivers.target_model_pre_save, sender=target_model, dispatch_uid='denorm_target_%s_pre_save'%target)
+    db_signals.post_save.connect(receivers.target_model_post_save, sender=target_model, dispatch_uid='denorm_target_%s_post_save'%target)
+
+def _connect_source_receivers(source_model, source):
+
+    db_signals.post_init.connect(receivers.source_model_post_init, sender=source_model, dispatch_uid='denorm_source_%s_post_init'%source)
+    db_signals.pre_save.connect(receivers.source_model_pre_save, sender=source_model, dispatch_uid='denorm_source_%s_pre_save'%source)
+    db_signals.post_save.connect(receivers.source_model_post_save, sender=source_model, dispatch_uid='denorm_source_%s_post_save'%source)
+
+# deferred subclasses of registered models that signal receivers have been connected to
+_DEFERRED_MODELS = set()
+
+def connect_deferred(instances):
+    """
+    Connects the signal receivers of registered models to the deferred subclasses of the given instances, which django
+    creates for querysets with only() or defer(), and which are the senders of signals of the instances they load.
+    Instances are expected to have been loaded before this call, so that they are snapshot like post_init would have
+    if their class was not connected yet.
+    """
+
+    connected = set()
+
+    for instance in instances:
+        model = instance.__class__
+
+        if not getattr(model, '_deferred', False):
+            continue
+
+        concrete_model = model._meta.concrete_model
+
+        if model not in _DEFERRED_MODELS:
+            _DEFERRED_MODELS.add(model)
+            connected.add(model)
+
+            # deferred class names are unique per model and set of deferred fields
+            name = '%s_%s' % (util.get_model_name(concrete_model), model.__name__)
+
+            if concrete_model in core.TARGET_GRAPH:
+                _connect_target_receivers(model, name)
+
+            if concrete_model in core.SOURCE_GRAPH:
+                _connect_source_receivers(model, name)
+
+        if model in connected:
+            if concrete_model in core.TARGET_GRAPH:
+                receivers.target_model_post_init(model, instance)
+
+            if concrete_model in core.SOURCE_GRAPH:
+                receivers.source_model_post_init(model, instance)
+
 def register(target_model, options):
     logging.info('[denorm.register] %s' % target_model)
 
@@ -58,18 +180,18 @@ def register(target_model, options):
     target = util.get_model_name(target_model)
     target_options = target_model._meta
 
+    metrics.connect_collector()
+
     # register signals for target. use dispatch_uid to prevent duplicates.
     # about signals: https://docs.djangoproject.com/en/1.8/topics/signals/
     # built-in signals: https://docs.djangoproject.com/en/1.8/ref/signals/
-    db_signals.post_init.connect(receivers.target_model_post_init, sender=target_model, dispatch_uid='denorm_target_%s_post_init'%target)
-    db_signals.pre_save.connect(receivers.target_model_pre_save, sender=target_model, dispatch_uid='denorm_target_%s_pre_save'%target)
-    db_signals.post_save.connect(receivers.target_model_post_save, sender=target_model, dispatch_uid='denorm_target_%s_post_save'%target)
+    _connect_target_receivers(target_model, target)
 
     target_graph = core.TARGET_GRAPH[target_model] = core.TARGET_GRAPH.get(target_model, {})
 
     for source, source_dict in options['sources'].iteritems():
 
-        strategy = source_dict.get('strategy', 'cursor') # options are: [cursor, mapreduce]. defaults to cursor.
+        strategy = source_dict.get('strategy', 'cursor') # options are: [cursor, sharded_cursor, mapreduce]. defaults to cursor.
 
         # TODO: support storage options 'list' and 'dict'
         storage = source_dict.get('storage', 'scalar') # choices: [scalar, shared_dict]
@@ -101,8 +223,11 @@ def register(target_model, options):
             except FieldDoesNotExist:
                 # field should not exist. now let's create it.
 
-                denorm_data_field = JSONField(name='denorm_data', null=True, blank=True,
-                                              decoder_kwargs={'cls': json_fields.JSONDecoder, 'parse_float':float})
+                if denorm_fields.DATA_FORMAT == 'compact':
+                    denorm_data_field = denorm_fields.CompactDenormDataField(name='denorm_data', null=True, blank=True)
+                else:
+                    denorm_data_field = JSONField(name='denorm_data', null=True, blank=True,
+                                                  decoder_kwargs={'cls': json_fields.JSONDecoder, 'parse_float':float})
                 denorm_data_field.contribute_to_class(target_model, 'denorm_data')
 
             else:
@@ -116,9 +241,7 @@ def register(target_model, options):
         source_options = source_model._meta
 
         # register signals for source. use dispatch_uid to prevent duplicates.
-        db_signals.post_init.connect(receivers.source_model_post_init, sender=source_model, dispatch_uid='denorm_source_%s_post_init'%source)
-        db_signals.pre_save.connect(receivers.source_model_pre_save, sender=source_model, dispatch_uid='denorm_source_%s_pre_save'%source)
-        db_signals.post_save.connect(receivers.source_model_post_save, sender=source_model, dispatch_uid='denorm_source_%s_post_save'%source)
+        _connect_source_receivers(source_model, source)
 
         # FIXME: it's quirky that label and throttles must be configured under each target-source in app's denorm_fields,
         # FIXME: but it gets applied here for entire source (not target dependent). it probably should be configured once
@@ -185,5 +308,17 @@ def register(target_model, options):
                 'source': source,
                 'strategy': strategy,
                 'storage': storage,
-                'shards': source_dict.get('shards') and util.convert_func_to_string(source_dict['shards'])
-            })
\ No newline at end of file
+                'shards': source_dict.get('shards') and util.convert_func_to_string(source_dict['shards']),
+                'min_page_size': source_dict.get('min_page_size'),
+                'max_page_size': source_dict.get('max_page_size'),
+                'lane': source_dict.get('lane')
+            })
+
+        core.MODELS_BY_NAME[util.get_model_name(source_model)] = source_model
+
+    core.MODELS_BY_NAME[target] = target_model
+    _compile_target_plan(target_model)
+
+    # recompile all source plans, because this registration may have chained targets of sources registered before
+    for source_model in core.SOURCE_GRAPH:
+        _compile_source_plan(source_model)
@@ -17,3 +17,27 @@ class TaskAdmin(ModelAdmin):
 
 if models.Task == models.get_task_model():
     admin.site.register(models.Task, TaskAdmin)
+
+class TaskRollupAdmin(ModelAdmin):
+    list_display = ['hour', 'source_model', 'label', 'count']
+    ordering = ['-hour']
+
+admin.site.register(models.TaskRollup, TaskRollupAdmin)
+
+class QueuedTaskAdmin(ModelAdmin):
+    list_display = ['created', 'queue_name', 'tag', 'eta']
+    ordering = ['eta']
+
+admin.site.register(models.QueuedTask, QueuedTaskAdmin)
+
+class RebuildShardAdmin(ModelAdmin):
+    list_display = ['target_model', 'sources', 'index', 'instances', 'written', 'done', 'modified']
+    ordering = ['target_model', 'sources', 'index']
+
+admin.site.register(models.RebuildShard, RebuildShardAdmin)
+
+class PayloadValueAdmin(ModelAdmin):
+    list_display = ['key', 'referenced']
+    ordering = ['-referenced']
+
+admin.site.register(models.PayloadValue, PayloadValueAdmin)
@@ -0,0 +1,42 @@
+#
+# Benchmarks for denorm hot paths. They run inside a project that has denorm installed, via:
+#
+#   python manage.py denorm_benchmark [<benchmark> ...]
+#
+# Each benchmark module exposes run(iterations), which returns a list of (name, value, unit) results.
+#
+
+from contextlib import contextmanager
+import time
+
+BENCHMARKS = [
+    'denorm.benchmarks.throttling',
+    'denorm.benchmarks.tasks',
+    'denorm.benchmarks.receivers',
+    'denorm.benchmarks.snapshots',
+    'denorm.benchmarks.fanout',
+    'denorm.benchmarks.denorm_data',
+]
+
+@contextmanager
+def patched(obj, **attrs):
+    """
+    Temporarily replaces attributes of obj, e.g. a module's reference to an App Engine api with a fake.
+    """
+    originals = dict((name, getattr(obj, name)) for name in attrs)
+    for name, value in attrs.iteritems():
+        setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        for name, value in originals.iteritems():
+            setattr(obj, name, value)
+
+def measure(func, iterations):
+    """
+    Returns the average wall-clock microseconds of calling func() iterations times.
+    """
+    start = time.time()
+    for _ in xrange(iterations):
+        func()
+    return (time.time() - start) * 1000000 / iterations
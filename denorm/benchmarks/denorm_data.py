@@ -0,0 +1,65 @@
+#
+# Compares the default JSON format of denorm_data with the compact format on synthetic shared_dict data: stored size,
+# decoding and encoding time, and the time to load and save an instance whose denorm_data is not accessed.
+#
+
+import json
+
+from json_field import fields as json_fields
+
+from denorm import fields
+from denorm.benchmarks import measure
+
+# (source pks per list, denormalized fields per source)
+SIZES = [(10, 3), (100, 3), (1000, 5)]
+
+class _Field(object):
+    attname = 'denorm_data'
+
+class _Instance(object):
+    denorm_data = fields._LazyDenormData(_Field())
+
+def _denorm_data(pks, field_count):
+    return {
+        'sources': dict((str(pk), dict(('field_%d' % i, 'value %d of %d' % (i, pk)) for i in xrange(field_count)))
+                        for pk in xrange(1, pks + 1)),
+    }
+
+def _json_encode(denorm_data):
+    return json.dumps(denorm_data, cls=json_fields.JSONEncoder)
+
+def _json_decode(raw):
+    return json.loads(raw, cls=json_fields.JSONDecoder, parse_float=float)
+
+def _load_and_save_untouched(raw):
+    instance = _Instance()
+    instance.denorm_data = raw
+    return _Instance.denorm_data.get_raw(instance)
+
+def run(iterations):
+
+    results = []
+
+    for pks, field_count in SIZES:
+        denorm_data = _denorm_data(pks, field_count)
+        json_raw = _json_encode(denorm_data)
+        compact_raw = fields.encode(denorm_data)
+        assert fields.decode(compact_raw) == denorm_data
+
+        label = '%d sources x %d fields' % (pks, field_count)
+
+        # large data takes long to encode, so measure it fewer times
+        count = max(1, iterations / pks)
+
+        results.extend([
+            ('%s: json size' % label, len(json_raw), 'bytes'),
+            ('%s: compact size' % label, len(compact_raw), 'bytes'),
+            ('%s: json decode' % label, measure(lambda: _json_decode(json_raw), count), 'us'),
+            ('%s: compact decode' % label, measure(lambda: fields.decode(compact_raw), count), 'us'),
+            ('%s: json encode' % label, measure(lambda: _json_encode(denorm_data), count), 'us'),
+            ('%s: compact encode' % label, measure(lambda: fields.encode(denorm_data), count), 'us'),
+            ('%s: json load and save' % label, measure(lambda: _json_encode(_json_decode(json_raw)), count), 'us'),
+            ('%s: compact load and save untouched' % label, measure(lambda: _load_and_save_untouched(compact_raw), count), 'us'),
+        ])
+
+    return results
@@ -0,0 +1,229 @@
+#
+# In-process stand-ins for the App Engine apis used by denorm, so that hot paths can be measured without App Engine.
+# Every api call that would be an RPC increments FakeQueue.rpcs.
+#
+
+from contextlib import contextmanager
+import time
+
+from django.db.models.loading import get_model
+from mapreduce.util import handler_for_name
+
+from denorm import queues, tasks, util
+from denorm.benchmarks import patched
+from denorm.strategies import cursor, map_reduce
+
+class FakeTransientError(Exception):
+    pass
+
+class FakeTask(object):
+
+    _counter = 0
+
+    def __init__(self, payload=None, tag=None, method='POST', url=None, headers=None, name=None, **kwargs):
+        FakeTask._counter += 1
+        self.name = name or 'task-%d' % FakeTask._counter
+        self.payload = payload
+        self.tag = tag
+        self.method = method
+        self.url = url
+        self.headers = headers
+        self.leased_until = 0
+
+class FakeQueue(object):
+    """
+    Queue with pull queue lease and tag semantics. Queues of the same name share their tasks, like real queues.
+    """
+
+    queues = {} # queue name => list of tasks
+    rpcs = 0
+
+    def __init__(self, name='default'):
+        self.name = name
+        self.tasks = FakeQueue.queues.setdefault(name, [])
+
+    @classmethod
+    def reset(cls):
+        cls.queues = {}
+        cls.rpcs = 0
+
+    def add(self, task):
+        FakeQueue.rpcs += 1
+        tasks = task if isinstance(task, list) else [task]
+        self.tasks.extend(tasks)
+        return task
+
+    def _lease(self, lease_seconds, max_tasks, tag=None):
+        FakeQueue.rpcs += 1
+        now = time.time()
+
+        leased = []
+        for task in self.tasks:
+            if len(leased) >= max_tasks:
+                break
+            if task.leased_until > now:
+                continue
+            if tag is not None and task.tag != tag:
+                continue
+            task.leased_until = now + lease_seconds
+            leased.append(task)
+
+        return leased
+
+    def lease_tasks(self, lease_seconds, max_tasks, deadline=10):
+        return self._lease(lease_seconds, max_tasks)
+
+    def lease_tasks_by_tag(self, lease_seconds, max_tasks, tag=None, deadline=10):
+        if tag is None:
+            # like the real api, lease tasks with the tag of the oldest task
+            available = [task for task in self.tasks if task.leased_until <= time.time()]
+            if not available:
+                FakeQueue.rpcs += 1
+                return []
+            tag = available[0].tag
+        return self._lease(lease_seconds, max_tasks, tag)
+
+    def delete_tasks(self, task):
+        FakeQueue.rpcs += 1
+        names = set(t.name for t in (task if isinstance(task, list) else [task]))
+        self.tasks[:] = [t for t in self.tasks if t.name not in names]
+
+class FakeTaskQueueModule(object):
+    """
+    Drop-in for the google.appengine.api.taskqueue module.
+    """
+
+    Queue = FakeQueue
+    Task = FakeTask
+    TransientError = FakeTransientError
+    MAX_PUSH_TASK_SIZE_BYTES = 100 * (2 ** 10)
+
+class FakeDeferredModule(object):
+    """
+    Drop-in for the google.appengine.ext.deferred module. Deferred calls are recorded as push tasks on FakeQueue, and
+    can be run with run_deferred.
+    """
+
+    @staticmethod
+    def serialize(func, *args, **kwargs):
+        # keep the call itself as payload, which is all run_deferred needs
+        return FakeDeferredCall(func, args, kwargs)
+
+    @staticmethod
+    def defer(func, *args, **kwargs):
+        queue_name = kwargs.pop('_queue', 'default')
+        for option in kwargs.keys():
+            if option.startswith('_'):
+                del kwargs[option]
+
+        FakeQueue(queue_name).add(FakeTask(payload=FakeDeferredCall(func, args, kwargs)))
+
+class FakeDeferredCall(object):
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __len__(self):
+        # deferred payloads are size checked against task size limits
+        return 0
+
+    def __call__(self):
+        return self.func(*self.args, **self.kwargs)
+
+def run_deferred(queue_name):
+    """
+    Runs deferred push tasks of queue_name, including tasks they defer in turn, until the queue is empty.
+    Returns the number of tasks run.
+    """
+
+    q = FakeQueue(queue_name)
+    count = 0
+
+    while q.tasks:
+        task = q.tasks.pop(0)
+        task.payload()
+        count += 1
+
+    return count
+
+
+def fake_get_cursor(queryset):
+    # cursors are plain offsets
+    return queryset.query.low_mark + len(queryset)
+
+def fake_set_cursor(queryset, cursor):
+    return queryset[cursor:]
+
+class FakeContext(object):
+
+    current = None
+
+    def __init__(self, params):
+        self.mapreduce_spec = type('MapreduceSpec', (object,), {})()
+        self.mapreduce_spec.mapper = type('MapperSpec', (object,), {'params': params})()
+
+class FakeContextModule(object):
+    """
+    Drop-in for the mapreduce.context module.
+    """
+
+    @staticmethod
+    def get():
+        return FakeContext.current
+
+class FakeMapperPipeline(object):
+    """
+    Drop-in for the mapper pipeline, which runs the mapper over all matching entities in-process when started.
+    """
+
+    _counter = 0
+    started = 0
+
+    def __init__(self, job_name, handler_spec, input_reader_spec, output_writer_spec=None, params=None, shards=None):
+        FakeMapperPipeline._counter += 1
+        self.pipeline_id = 'pipeline-%d' % FakeMapperPipeline._counter
+        self.job_name = job_name
+        self.handler_spec = handler_spec
+        self.params = params
+        self.shards = shards
+        self.mapper_calls = 0
+
+    def start(self, queue_name=None):
+        FakeMapperPipeline.started += 1
+
+        # entity kind is encoded as <app_label>.<model name>
+        model = get_model(*self.params['entity_kind'].split('.', 1))
+        queryset = model.objects.filter(**dict((name, value) for name, op, value in self.params['filters']))
+
+        handler = handler_for_name(self.handler_spec)
+        FakeContext.current = FakeContext(self.params)
+        try:
+            for entity in queryset:
+                for _ in handler(entity):
+                    pass
+                self.mapper_calls += 1
+        finally:
+            FakeContext.current = None
+
+def fake_batch_save(entity, save_params={}):
+    # without the djangoappengine batch op customization, just save
+    entity.save(**save_params)
+
+@contextmanager
+def offline():
+    """
+    Replaces all App Engine apis denorm uses with fakes, and resets fake queues.
+    """
+
+    FakeQueue.reset()
+    FakeMapperPipeline.started = 0
+
+    # pull tasks go through the app engine backend, so that fake queues count their rpcs whatever backend is configured
+    with patched(queues, taskqueue=FakeTaskQueueModule, _backend=queues.TaskQueueBackend()), \
+         patched(tasks, taskqueue=FakeTaskQueueModule, deferred=FakeDeferredModule, TASK_MIN_AGE_SECONDS=0), \
+         patched(cursor, get_cursor=fake_get_cursor, set_cursor=fake_set_cursor, BATCH_SAVE=False), \
+         patched(map_reduce, MapperPipeline=FakeMapperPipeline, context=FakeContextModule), \
+         patched(util, deferred=FakeDeferredModule, batch_save=fake_batch_save):
+        yield
@@ -0,0 +1,98 @@
+#
+# End-to-end benchmark of synthetic registered models, with all App Engine apis replaced by in-process fakes. Reports
+# per-save receiver overhead, enqueue cost, tasks merged per drain and fan-out throughput per strategy.
+#
+
+import time
+
+from denorm import buffering, models, queues, tasks, util
+from denorm.benchmarks import fakes, measure, patched
+from denorm.benchmarks.models import BenchmarkSource, TARGET_MODELS
+
+def _rename(source):
+    # change a denormalized field on every call
+    source.name = 'name %f' % time.time()
+    source.save()
+
+def _save_overhead(iterations):
+
+    source = BenchmarkSource.objects.create(name='name', code='code')
+
+    results = [
+        ('source save: no denormalized field changed', measure(source.save, iterations), 'us'),
+    ]
+
+    source._denorm = False
+    results.append(('source save: denorm disabled', measure(lambda: _rename(source), iterations), 'us'))
+    source._denorm = True
+
+    fakes.FakeQueue.rpcs = 0
+    results.extend([
+        ('source save: denormalizing', measure(lambda: _rename(source), iterations), 'us'),
+        ('source save: enqueue rpcs per denormalizing save', float(fakes.FakeQueue.rpcs) / iterations, 'rpcs'),
+    ])
+
+    # time includes the flush at the end of the buffer
+    fakes.FakeQueue.rpcs = 0
+    with buffering.coalesce():
+        seconds = measure(lambda: _rename(source), iterations)
+        start = time.time()
+    seconds += (time.time() - start) * 1000000 / iterations
+    results.extend([
+        ('source save: denormalizing, coalesced', seconds, 'us'),
+        ('source save: enqueue rpcs per denormalizing save, coalesced', float(fakes.FakeQueue.rpcs) / iterations, 'rpcs'),
+    ])
+
+    return results
+
+def _drain_merges():
+
+    pull_tasks = len(fakes.FakeQueue(queues.PULL_QUEUE_NAME).tasks)
+
+    with patched(tasks, DRAIN_BATCH_SIZE=util.MAX_TASKS_PER_LEASE):
+        tasks.setup_denorm_task(1)
+
+    push_tasks = len(fakes.FakeQueue(queues.PUSH_QUEUE_NAME).tasks)
+    fakes.FakeQueue(queues.PUSH_QUEUE_NAME).tasks[:] = []
+
+    return [
+        ('drain: pull tasks merged per dispatched task', float(pull_tasks) / max(push_tasks, 1), 'tasks'),
+    ]
+
+def _fan_out(strategy, num_targets):
+
+    target_model = TARGET_MODELS[strategy]
+
+    source = BenchmarkSource.objects.create(name='name', code='code')
+    target_model.objects.bulk_create([target_model(source=source, value=i) for i in xrange(num_targets)])
+
+    start = time.time()
+
+    _rename(source)
+    tasks.setup_denorm_task(1)
+    fakes.run_deferred(queues.PUSH_QUEUE_NAME)
+
+    seconds = time.time() - start
+
+    if any(target.source_name != source.name for target in target_model.objects.filter(source=source)):
+        raise AssertionError('%s strategy did not denormalize all targets' % strategy)
+
+    return ('fan-out: %s targets per second' % strategy, num_targets / seconds, 'targets/s')
+
+def run(iterations):
+
+    try:
+        with fakes.offline():
+            results = _save_overhead(iterations)
+            results.extend(_drain_merges())
+
+            for strategy in sorted(TARGET_MODELS.keys()):
+                results.append(_fan_out(strategy, iterations))
+
+        return results
+
+    finally:
+        for target_model in TARGET_MODELS.values():
+            target_model.objects.all().delete()
+        BenchmarkSource.objects.all().delete()
+        models.get_task_model().objects.filter(source_model=util.get_model_name(BenchmarkSource)).delete()
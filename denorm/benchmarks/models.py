@@ -0,0 +1,53 @@
+#
+# Synthetic source and target models for benchmarks. They are only defined and registered when a benchmark imports this
+# module, and rely on a schemaless datastore such as the local App Engine datastore stub, so no tables are needed.
+#
+
+from django.db import models
+
+import denorm
+
+class BenchmarkSource(models.Model):
+    name = models.CharField(max_length=100)
+    code = models.CharField(max_length=20)
+
+    class Meta:
+        app_label = 'denorm'
+
+class BenchmarkCursorTarget(models.Model):
+    source = models.ForeignKey(BenchmarkSource, related_name='benchmark_cursor_targets')
+    value = models.IntegerField(default=0)
+
+    class Meta:
+        app_label = 'denorm'
+
+class BenchmarkShardedCursorTarget(models.Model):
+    source = models.ForeignKey(BenchmarkSource, related_name='benchmark_sharded_cursor_targets')
+    value = models.IntegerField(default=0)
+
+    class Meta:
+        app_label = 'denorm'
+
+class BenchmarkMapReduceTarget(models.Model):
+    source = models.ForeignKey(BenchmarkSource, related_name='benchmark_mapreduce_targets')
+    value = models.IntegerField(default=0)
+
+    class Meta:
+        app_label = 'denorm'
+
+# target model per strategy
+TARGET_MODELS = {
+    'cursor': BenchmarkCursorTarget,
+    'sharded_cursor': BenchmarkShardedCursorTarget,
+    'mapreduce': BenchmarkMapReduceTarget,
+}
+
+for strategy, target_model in TARGET_MODELS.iteritems():
+    denorm.register(target_model, {
+        'sources': {
+            'source': {
+                'strategy': strategy,
+                'fields': ['name', 'code'],
+            },
+        }
+    })
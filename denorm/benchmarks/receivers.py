@@ -0,0 +1,49 @@
+#
+# Measures per-instance post_init receiver overhead of registered models, comparing the compiled plans against the
+# registration graph walk the receivers used to do.
+#
+
+from inflector.inflector import Inflector
+
+from denorm import core, receivers
+from denorm.benchmarks import measure
+
+def _graph_target_post_init(target_model, target_instance):
+
+    orig_sources = {}
+
+    for source_field, target_data in core.TARGET_GRAPH[target_model].iteritems():
+        if target_data['storage'] == 'scalar':
+            orig_sources[source_field] = getattr(target_instance, source_field + '_id')
+        else:
+            source_list_field = Inflector().pluralize(source_field)
+            orig_sources[source_list_field] = getattr(target_instance, source_list_field)
+
+def _graph_source_post_init(source_model, source_instance):
+
+    orig_values = {}
+
+    for source_field in core.SOURCE_GRAPH[source_model]['fields']:
+        orig_values[source_field] = getattr(source_instance, source_field)
+
+def run(iterations):
+
+    results = []
+
+    for target_model, target_plan in core.TARGET_PLANS.iteritems():
+        instance = target_model(id=1)
+
+        results.extend([
+            ('target post_init %s: graph' % target_plan.model_name, measure(lambda: _graph_target_post_init(target_model, instance), iterations), 'us'),
+            ('target post_init %s: plan' % target_plan.model_name, measure(lambda: receivers.target_model_post_init(target_model, instance), iterations), 'us'),
+        ])
+
+    for source_model, source_plan in core.SOURCE_PLANS.iteritems():
+        instance = source_model(id=1)
+
+        results.extend([
+            ('source post_init %s: graph' % source_plan.model_name, measure(lambda: _graph_source_post_init(source_model, instance), iterations), 'us'),
+            ('source post_init %s: plan' % source_plan.model_name, measure(lambda: receivers.source_model_post_init(source_model, instance), iterations), 'us'),
+        ])
+
+    return results
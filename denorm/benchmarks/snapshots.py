@@ -0,0 +1,67 @@
+#
+# Measures queryset iteration throughput of registered models with denorm post_init receivers disconnected, with
+# eager snapshots and with lazy snapshots. Iterates up to `iterations` existing rows per model.
+#
+
+import time
+
+from django.db.models import signals as db_signals
+
+from denorm import core, receivers
+from denorm.benchmarks import patched
+
+def _iterate(model, limit):
+
+    start = time.time()
+    count = len(list(model.objects.all()[:limit]))
+    seconds = time.time() - start
+
+    return count / seconds if count else 0
+
+def _post_init_receivers(model):
+    """
+    Returns the (receiver, dispatch_uid) pairs registration connected to model's post_init.
+    """
+
+    connected = []
+
+    if model in core.TARGET_PLANS:
+        connected.append((receivers.target_model_post_init, 'denorm_target_%s_post_init' % core.TARGET_PLANS[model].model_name))
+
+    if model in core.SOURCE_PLANS:
+        # source receivers are connected with a dispatch_uid per related field name
+        related_field_names = set(target.source for source_field, targets in core.SOURCE_PLANS[model].fields for target in targets)
+        for related_field_name in related_field_names:
+            connected.append((receivers.source_model_post_init, 'denorm_source_%s_post_init' % related_field_name))
+
+    return connected
+
+def run(iterations):
+
+    results = []
+
+    for model in set(core.TARGET_PLANS.keys() + core.SOURCE_PLANS.keys()):
+        model_name = (core.TARGET_PLANS.get(model) or core.SOURCE_PLANS.get(model)).model_name
+        connected = _post_init_receivers(model)
+
+        for receiver, dispatch_uid in connected:
+            db_signals.post_init.disconnect(sender=model, dispatch_uid=dispatch_uid)
+        try:
+            unregistered = _iterate(model, iterations)
+        finally:
+            for receiver, dispatch_uid in connected:
+                db_signals.post_init.connect(receiver, sender=model, dispatch_uid=dispatch_uid)
+
+        with patched(receivers, LAZY_SNAPSHOTS=False):
+            eager = _iterate(model, iterations)
+
+        with patched(receivers, LAZY_SNAPSHOTS=True):
+            lazy = _iterate(model, iterations)
+
+        results.extend([
+            ('queryset iteration %s: unregistered' % model_name, unregistered, 'rows/s'),
+            ('queryset iteration %s: eager snapshots' % model_name, eager, 'rows/s'),
+            ('queryset iteration %s: lazy snapshots' % model_name, lazy, 'rows/s'),
+        ])
+
+    return results
@@ -0,0 +1,63 @@
+#
+# Counts pull queue RPCs per drained task of setup_denorm_task, serial mode vs drain mode, using fake task queues.
+#
+
+from datetime import timedelta
+import time
+
+from django.utils import timezone
+
+from denorm import queues, tasks, util
+from denorm.benchmarks import fakes, patched
+
+# average number of duplicate tasks per tag
+TASKS_PER_TAG = 4
+
+def _fill_queue(num_tasks):
+
+    created = (timezone.now() - timedelta(hours=1)).isoformat()
+    q = fakes.FakeQueue(queues.PULL_QUEUE_NAME)
+
+    for i in xrange(num_tasks):
+        instance_id = i % max(num_tasks / TASKS_PER_TAG, 1)
+        payload = {
+            'created': created,
+            'strategy': 'cursor',
+            'storage': 'scalar',
+            'instance_id': instance_id,
+            'source_model': 'benchmark.Source',
+            'target_model': 'benchmark.Target',
+            'related_field': 'source',
+            'fields': {'source_name': 'name %d' % i},
+            'queue_name': queues.PUSH_QUEUE_NAME
+        }
+        q.add(fakes.FakeTask(payload=util.dump_json(payload), tag='DENORM_SOURCE_%d' % instance_id, method='PULL'))
+
+def _drain(num_tasks, drain_batch_size):
+
+    with fakes.offline(), patched(tasks, DRAIN_BATCH_SIZE=drain_batch_size):
+        _fill_queue(num_tasks)
+        fakes.FakeQueue.rpcs = 0
+
+        start = time.time()
+        tasks.setup_denorm_task(1)
+        seconds = time.time() - start
+
+        dispatched = len(fakes.FakeQueue(queues.PUSH_QUEUE_NAME).tasks)
+
+    return fakes.FakeQueue.rpcs, seconds, dispatched
+
+def run(iterations):
+
+    results = []
+
+    for mode, drain_batch_size in [('serial', None), ('drain', util.MAX_TASKS_PER_LEASE)]:
+        rpcs, seconds, dispatched = _drain(iterations, drain_batch_size)
+
+        results.extend([
+            ('setup_denorm_task %s: rpcs per drained task' % mode, float(rpcs) / iterations, 'rpcs'),
+            ('setup_denorm_task %s: tasks merged per dispatch' % mode, float(iterations) / max(dispatched, 1), 'tasks'),
+            ('setup_denorm_task %s: time per drained task' % mode, seconds * 1000000 / iterations, 'us'),
+        ])
+
+    return results
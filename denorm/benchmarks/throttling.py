@@ -0,0 +1,36 @@
+#
+# Compares the throttle check of the Task table COUNT backend against the sliding window log backends.
+#
+
+import uuid
+
+from denorm import models, throttling
+from denorm.benchmarks import measure
+
+# throttles are never exceeded by TASK_ROWS, so that every throttle gets checked on every call
+THROTTLES = ['100/min', '500/hour', '1000/day']
+TASK_ROWS = 50
+
+def run(iterations):
+
+    label = 'denorm-benchmark-%s' % uuid.uuid4().hex
+    task_model = models.get_task_model()
+
+    count_backend = throttling.TaskCountThrottleBackend()
+    local_backend = throttling.LocalMemoryThrottleBackend()
+    cache_backend = throttling.CacheThrottleBackend()
+
+    for _ in xrange(TASK_ROWS):
+        task_model.objects.create(source_model='denorm.Benchmark', source_instance_id=0, label=label)
+        local_backend.record(label, THROTTLES)
+        cache_backend.record(label, THROTTLES)
+
+    try:
+        return [
+            ('throttle check: task count', measure(lambda: count_backend.is_throttled(label, THROTTLES), iterations), 'us'),
+            ('throttle check: local memory', measure(lambda: local_backend.is_throttled(label, THROTTLES), iterations), 'us'),
+            ('throttle check: cache', measure(lambda: cache_backend.is_throttled(label, THROTTLES), iterations), 'us'),
+            ('throttle record: local memory', measure(lambda: local_backend.record(label, THROTTLES), iterations), 'us'),
+        ]
+    finally:
+        task_model.objects.filter(label=label).delete()
@@ -0,0 +1,156 @@
+#
+# Write-behind buffer for denorm enqueues. While a buffer is active in the current thread, source saves do not add
+# their pull tasks and Task rows right away. Instead, pull tasks get merged per tag (i.e. per source instance and target
+# model) the same way setup_denorm_task merges them, and Task rows per source instance. When the outermost buffer ends,
+# the merged pull tasks are added with batched Queue.add calls, and the Task rows with one bulk insert. Throttle checks
+# count the buffered Task rows of their label as well, so that throttles still apply within a buffer.
+#
+# Activate a buffer for each request with DenormBufferMiddleware, or around any block of code with coalesce():
+#
+#   with buffering.coalesce():
+#       for row in rows:
+#           import_row(row)
+#
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import local
+import logging, time
+
+from denorm import models, payloads, queues, signals, throttling, util, versions
+
+_thread_locals = local()
+
+class _Buffer(object):
+
+    def __init__(self):
+        self.depth = 0
+        self.payloads = OrderedDict() # tag => payload
+        self.task_rows = OrderedDict() # (source model name, source instance id) => (task row kwargs, throttles)
+        self.label_times = {} # label => OrderedDict of (source model name, source instance id) => time of latest save
+
+    def add(self, pull_tasks, task_row, throttles):
+
+        for tag, payload in pull_tasks:
+            orig_payload = self.payloads.get(tag)
+
+            if orig_payload:
+                # newer payload has priority, but keeps fields only affected by older saves
+                payload = util.merge_payloads(orig_payload, payload)
+
+            self.payloads[tag] = payload
+
+        if task_row:
+            key = (task_row['source_model'], task_row['source_instance_id'])
+
+            orig_task_row = self.task_rows.get(key)
+            if orig_task_row:
+                self.label_times.get(orig_task_row[0]['label'], {}).pop(key, None)
+
+            self.task_rows[key] = (task_row, throttles)
+
+            if task_row['label']:
+                self.label_times.setdefault(task_row['label'], OrderedDict())[key] = time.time()
+
+def _get_buffer():
+    return getattr(_thread_locals, 'buffer', None)
+
+def begin():
+    """
+    Starts buffering enqueues in the current thread. Calls may be nested, and only the outermost end() flushes.
+    """
+
+    buf = _get_buffer()
+    if buf is None:
+        buf = _thread_locals.buffer = _Buffer()
+
+    buf.depth += 1
+
+def end():
+    """
+    Ends buffering, and writes out buffered pull tasks and Task rows if this was the outermost buffer.
+    """
+
+    buf = _get_buffer()
+    if buf is None:
+        return
+
+    buf.depth -= 1
+    if buf.depth > 0:
+        return
+
+    _thread_locals.buffer = None
+
+    if buf.payloads or buf.task_rows:
+        logging.info('[denorm.buffering.end] flush %d pull tasks for %d source instances' % (len(buf.payloads), len(buf.task_rows)))
+        write(buf.payloads.items(), buf.task_rows.values())
+
+@contextmanager
+def coalesce():
+
+    begin()
+    try:
+        yield
+    finally:
+        # source saves already happened even if an exception was raised, so we always flush
+        end()
+
+def get_pending_times(label):
+    """
+    Returns the times, oldest first, of the Task rows of label that are buffered in the current thread and not written
+    yet, so that throttle checks can count them.
+    """
+
+    buf = _get_buffer()
+    if buf is None:
+        return []
+
+    return list(buf.label_times.get(label, {}).itervalues())
+
+def enqueue(pull_tasks, task_row, throttles):
+    """
+    Enqueues pull tasks, given as (tag, payload) pairs, of a source save and its Task row kwargs, or None for no Task row.
+    They are buffered if a buffer is active, or else written right away.
+    """
+
+    buf = _get_buffer()
+
+    if buf is not None:
+        buf.add(pull_tasks, task_row, throttles)
+    else:
+        write(pull_tasks, [(task_row, throttles)] if task_row else [])
+
+def write(pull_tasks, task_rows):
+
+    tasks = []
+
+    for tag, payload in pull_tasks:
+        payload_string = payloads.dump(payload)
+
+        logging.info('[denorm.buffering.write] queue task payload = %s' % payload_string)
+
+        tasks.append((tag, payload_string))
+
+        signals.denorm_enqueued.send(sender=util.get_model_by_name(payload['target_model']),
+                                     source_model=util.get_model_by_name(payload['source_model']))
+
+    queues.get_queue_backend().add(tasks)
+
+    # stamp versions only once pull tasks are added, so that fan-outs are never dropped for a task that was not
+    if versions.VERSION_STAMPS:
+        versions.stamp(payload for tag, payload in pull_tasks)
+
+    # Task model instances are used to track denorm tasks per source, particularly for throttling
+    task_model = models.get_task_model()
+
+    if not task_rows:
+        return
+    elif len(task_rows) == 1:
+        task_model.objects.create(**task_rows[0][0])
+    else:
+        task_model.objects.bulk_create([task_model(**kwargs) for kwargs, throttles in task_rows])
+
+    # let throttle backend count the tasks we just tracked
+    for kwargs, throttles in task_rows:
+        if kwargs['label'] and throttles:
+            throttling.get_throttle_backend().record(kwargs['label'], throttles)
@@ -1,4 +1,81 @@
-
 # graphs built up by registration process
 TARGET_GRAPH = {}
-SOURCE_GRAPH = {}
\ No newline at end of file
+SOURCE_GRAPH = {}
+
+# plans compiled from the graphs by registration process, so that signal receivers do not need to derive field names
+# per instance
+TARGET_PLANS = {}
+SOURCE_PLANS = {}
+
+# registered models by util.get_model_name
+MODELS_BY_NAME = {}
+
+class Plan(object):
+    """
+    Immutable record of precomputed registration data.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            object.__setattr__(self, name, kwargs[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (name, getattr(self, name)) for name in self.__slots__))
+
+class TargetPlan(Plan):
+
+    __slots__ = (
+        'model_name',
+        'sources', # TargetSourcePlan per registered source field
+        'orig_source_attnames', # (key in _denorm_orig_sources, attname) pairs to snapshot on post_init
+    )
+
+    def get_source(self, source):
+        for source_plan in self.sources:
+            if source_plan.source == source:
+                return source_plan
+        raise KeyError(source)
+
+class TargetSourcePlan(Plan):
+
+    __slots__ = (
+        'source', # related field name, as configured in registration
+        'storage',
+        'source_model',
+        'attname', # foreign key attname for scalar storage
+        'list_field_name', # pluralized list field name for shared_dict storage
+        'field_names', # source model attnames to denormalize
+        'target_field_names', # (source attname, target attname) pairs for scalar storage
+    )
+
+class SourcePlan(Plan):
+
+    __slots__ = (
+        'model_name',
+        'label',
+        'throttles',
+        'fields', # (source attname, SourceTargetPlan tuple) pairs
+        'field_names', # source attnames to snapshot on post_init
+        'orig_value_attnames', # (key in _denorm_orig_values, attname) pairs, which are identical for sources
+    )
+
+class SourceTargetPlan(Plan):
+
+    __slots__ = (
+        'target_model',
+        'target_model_name',
+        'source', # related field name on target model
+        'strategy',
+        'storage',
+        'shards',
+        'min_page_size', # bounds of cursor strategy page sizes, or None
+        'max_page_size',
+        'lane', # push queue pinned by registration, or None to route by fan-out size
+        'target_field_name', # target field name, or denorm_data key for shared_dict storage
+        'chained', # whether target field is in turn a source field of other targets
+    )
@@ -1,4 +1,8 @@
 
 class DenormThrottled(Exception):
 
-    pass
\ No newline at end of file
+    pass
+
+class QueueTransientError(Exception):
+
+    pass
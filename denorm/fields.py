@@ -0,0 +1,180 @@
+#
+# Compact storage for the denorm_data field of shared_dict storage, chosen with settings.DENORM_DATA_FORMAT = 'compact'.
+#
+# The default JSONField stores {<list field>: {<source pk>: {<field>: <value>, ...}, ...}, ...}, repeating every field
+# name for every source pk, and is decoded whenever an instance is loaded. CompactDenormDataField stores the field names
+# once per list field, and a row of values per source pk:
+#
+#   ~1{"<list field>": {"fields": ["<field>", ...], "rows": {"<source pk>": [<value>, ...], ...}}, ...}
+#
+# Entries that do not have exactly the header fields are stored as they are. The stored string is only decoded when
+# denorm_data is accessed, and is written back as it was if it was not.
+#
+# Strings without the format prefix are decoded as the default JSON format, so existing data converts to the compact
+# format as instances are saved, or all at once with `python manage.py denorm_compact_data <app.Model>`.
+#
+
+import json
+
+from django.conf import settings
+from django.db import models
+from json_field import fields as json_fields
+
+# 'json' for the default JSONField, or 'compact' for CompactDenormDataField
+DATA_FORMAT = getattr(settings, 'DENORM_DATA_FORMAT', 'json')
+
+FORMAT_PREFIX = '~1'
+
+def encode(denorm_data):
+    """
+    Returns denorm_data encoded in the compact format.
+    """
+
+    lists = {}
+
+    for list_field_name, entries in denorm_data.iteritems():
+        field_names = sorted(set(field for values in entries.itervalues() for field in values))
+        field_set = set(field_names)
+
+        rows = {}
+        for source_pk, values in entries.iteritems():
+            if len(values) == len(field_names) and field_set.issuperset(values):
+                rows[source_pk] = [values[field] for field in field_names]
+            else:
+                rows[source_pk] = values
+
+        lists[list_field_name] = {'fields': field_names, 'rows': rows}
+
+    # keys are sorted, so that data that was decoded but not changed encodes to the stored string again
+    return FORMAT_PREFIX + json.dumps(lists, cls=json_fields.JSONEncoder, separators=(',', ':'), sort_keys=True)
+
+def decode(raw):
+    """
+    Returns denorm_data decoded from either the compact or the default JSON format.
+    """
+
+    if not raw:
+        return None
+
+    if not raw.startswith(FORMAT_PREFIX):
+        return json.loads(raw, cls=json_fields.JSONDecoder, parse_float=float)
+
+    lists = json.loads(raw[len(FORMAT_PREFIX):], cls=json_fields.JSONDecoder, parse_float=float)
+
+    denorm_data = {}
+
+    for list_field_name, compact in lists.iteritems():
+        field_names = compact['fields']
+        denorm_data[list_field_name] = dict(
+            (source_pk, dict(zip(field_names, row)) if isinstance(row, list) else row)
+            for source_pk, row in compact['rows'].iteritems()
+        )
+
+    return denorm_data
+
+class _LazyDenormData(object):
+    """
+    Descriptor keeping the stored string of an instance's denorm_data, and decoding it on first access.
+    """
+
+    def __init__(self, field):
+        self.raw_attr = '_%s_raw' % field.attname
+        self.value_attr = '_%s_value' % field.attname
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        if self.value_attr not in instance.__dict__:
+            instance.__dict__[self.value_attr] = decode(instance.__dict__.get(self.raw_attr))
+
+        return instance.__dict__[self.value_attr]
+
+    def __set__(self, instance, value):
+        if self.raw_attr not in instance.__dict__ and self.value_attr not in instance.__dict__ and \
+                (value is None or isinstance(value, basestring)):
+            # the first assignment is by Model.__init__, which gets the stored string of a loaded instance
+            self._set_raw(instance, value)
+        else:
+            # later assignments are values, even if they are strings
+            instance.__dict__[self.value_attr] = value
+
+    def _set_raw(self, instance, raw):
+        instance.__dict__[self.raw_attr] = raw
+        instance.__dict__.pop(self.value_attr, None)
+
+    def get_raw(self, instance):
+        """
+        Returns the string to store for instance, encoding its denorm_data only if it was accessed.
+        """
+
+        if self.value_attr in instance.__dict__:
+            value = instance.__dict__[self.value_attr]
+            if isinstance(value, dict):
+                instance.__dict__[self.raw_attr] = encode(value) if value else None
+            else:
+                # other values are stored in the default JSON format, which decode() reads as well
+                instance.__dict__[self.raw_attr] = json.dumps(value, cls=json_fields.JSONEncoder) if value is not None else None
+
+        return instance.__dict__.get(self.raw_attr)
+
+def has_denorm_data(instance, list_field_name):
+    """
+    Returns whether the denorm_data of instance holds entries of list_field_name, without decoding the stored string of a
+    CompactDenormDataField that was not accessed yet.
+    """
+
+    descriptor = getattr(instance.__class__, 'denorm_data', None)
+
+    if isinstance(descriptor, _LazyDenormData) and descriptor.value_attr not in instance.__dict__:
+        # list field names are keys of the stored JSON object
+        raw = instance.__dict__.get(descriptor.raw_attr)
+        return bool(raw) and '"%s"' % list_field_name in raw
+
+    return list_field_name in (getattr(instance, 'denorm_data', None) or {})
+
+class CompactDenormDataField(models.TextField):
+
+    def contribute_to_class(self, cls, name):
+        super(CompactDenormDataField, self).contribute_to_class(cls, name)
+        setattr(cls, self.attname, _LazyDenormData(self))
+
+    def pre_save(self, model_instance, add):
+        return getattr(model_instance.__class__, self.attname).get_raw(model_instance)
+
+    def get_prep_value(self, value):
+        if value is None or isinstance(value, basestring):
+            return value
+        return encode(value) if value else None
+
+    def value_to_string(self, obj):
+        return self.pre_save(obj, False)
+
+def compact_denorm_data(model, batch_size=100):
+    """
+    Converts denorm_data of all instances of model from the default JSON format to the compact format, in batches of
+    batch_size in primary key order. Rows are updated directly, so that no signal receivers run. Returns the number of
+    converted instances.
+    """
+
+    converted = 0
+    last_pk = None
+
+    while True:
+        queryset = model.objects.order_by('pk')
+        if last_pk is not None:
+            queryset = queryset.filter(pk__gt=last_pk)
+
+        # values_list returns the stored strings, without decoding them
+        rows = list(queryset.values_list('pk', 'denorm_data')[:batch_size])
+        if not rows:
+            break
+
+        for pk, raw in rows:
+            if raw and not raw.startswith(FORMAT_PREFIX):
+                model.objects.filter(pk=pk).update(denorm_data=encode(decode(raw)))
+                converted += 1
+
+        last_pk = rows[-1][0]
+
+    return converted
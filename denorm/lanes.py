@@ -0,0 +1,142 @@
+#
+# Fan-out size lanes. By default, all fan-outs run on the denorm push queue, so a source with a huge number of targets
+# can delay the small fan-outs queued after it. With settings.DENORM_LANES, setup_denorm_task routes each fan-out to the
+# push queue of the first lane whose maximum size fits its estimated number of target instances, e.g.:
+#
+#   DENORM_LANES = [
+#       (100, 'denorm-small'),
+#       (10000, 'denorm-medium'),
+#       (None, 'denorm-large'), # no maximum
+#   ]
+#
+# Each lane's concurrency is that of its queue, as configured in queue.yaml. Fan-outs larger than the maximum of every
+# lane run on the denorm push queue.
+#
+# Fan-out sizes are estimated with a count of the target instances, which is limited to one more than the smallest lane
+# maximum, and only repeated with the next larger maximum if the count exceeds it. Estimates are kept in the Django cache
+# for DENORM_LANE_ESTIMATE_TIMEOUT seconds (one hour by default). Completed cursor chains and mapreduce jobs update the
+# estimate of their source instance with the number of instances they processed, and a running average per target
+# model and related field. Each dispatch runs at most DENORM_LANE_MAX_COUNTS (10) counts, and estimates fan-outs past
+# that with the average of their target model and related field, or runs them on the denorm push queue if there is none.
+#
+# Registrations can pin a lane with the 'lane' source option, which names a push queue. Fan-outs of pinned sources are
+# not counted.
+#
+
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+from denorm import core, util
+
+LANES = getattr(settings, 'DENORM_LANES', None)
+LANE_CACHE_PREFIX = getattr(settings, 'DENORM_LANE_CACHE_PREFIX', 'denorm_lane')
+LANE_ESTIMATE_TIMEOUT = getattr(settings, 'DENORM_LANE_ESTIMATE_TIMEOUT', 3600)
+LANE_MAX_COUNTS = getattr(settings, 'DENORM_LANE_MAX_COUNTS', 10)
+
+def _key(payload):
+    return '%s:%s:%s:%s:%s' % (LANE_CACHE_PREFIX, payload['source_model'], payload['instance_id'], payload['target_model'],
+                               payload['related_field'])
+
+def _average_key(payload):
+    return '%s:%s:%s' % (LANE_CACHE_PREFIX, payload['target_model'], payload['related_field'])
+
+def _count(payload, limit):
+
+    target_model = util.get_model_by_name(payload['target_model'])
+
+    if payload['storage'] == 'scalar':
+        filters = {payload['related_field'] + '_id': payload['instance_id']}
+    else:
+        # shared_dict targets hold the source primary key in their list field
+        filters = {core.TARGET_PLANS[target_model].get_source(payload['related_field']).list_field_name: payload['instance_id']}
+
+    return target_model.objects.filter(**filters)[:limit].count()
+
+def record_size(payload, instances):
+    """
+    Updates the estimates of the fan-out of payload, and the average of its target model and related field, with the
+    number of target instances it processed.
+    """
+
+    if not LANES:
+        return
+
+    cache.set(_key(payload), instances, LANE_ESTIMATE_TIMEOUT)
+
+    # smooth average, like the seconds per instance of cursor pages
+    average = cache.get(_average_key(payload))
+    cache.set(_average_key(payload), instances if average is None else (average + instances) / 2.0, LANE_ESTIMATE_TIMEOUT)
+
+class Router(object):
+    """
+    Routes the fan-outs of one dispatch to lanes, counting target instances at most LANE_MAX_COUNTS times.
+    """
+
+    def __init__(self, max_counts=LANE_MAX_COUNTS):
+        self.counts_left = max_counts
+
+    def estimate_size(self, payload):
+        """
+        Returns the estimated number of target instances of the fan-out of payload, or None if there is no estimate and
+        no counts are left.
+        """
+
+        key = _key(payload)
+
+        size = cache.get(key)
+        if size is not None:
+            return size
+
+        maximums = sorted(max_size for max_size, queue_name in LANES if max_size is not None)
+        if not maximums:
+            # every fan-out fits the lane without maximum
+            return 0
+
+        size = None
+        exact = False
+
+        for max_size in maximums:
+            if not self.counts_left:
+                break
+
+            self.counts_left -= 1
+            size = _count(payload, max_size + 1)
+            if size <= max_size:
+                exact = True
+                break
+        else:
+            # counted past every maximum, which routes like the actual size
+            exact = True
+
+        if exact:
+            cache.set(key, size, LANE_ESTIMATE_TIMEOUT)
+            return size
+
+        # out of counts. a count past a smaller maximum is only a lower bound, so it is not cached.
+        average = cache.get(_average_key(payload))
+        if average is not None and (size is None or average > size):
+            return average
+
+        return size
+
+    def get_queue_name(self, payload):
+        """
+        Returns the push queue to run the fan-out of payload on: its pinned lane, or the lane that fits its estimated
+        size.
+        """
+
+        if payload.get('lane') or not LANES:
+            return payload['queue_name']
+
+        size = self.estimate_size(payload)
+        if size is None:
+            return payload['queue_name']
+
+        for max_size, queue_name in LANES:
+            if max_size is None or size <= max_size:
+                logging.info('[denorm.lanes.get_queue_name] route fan-out of estimated size %d to %s' % (size, queue_name))
+                return queue_name
+
+        return payload['queue_name']
@@ -0,0 +1,31 @@
+from importlib import import_module
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from denorm.benchmarks import BENCHMARKS
+
+class Command(BaseCommand):
+    args = '[<benchmark> ...]'
+    help = 'Runs denorm benchmarks. Benchmark names are module names in denorm.benchmarks, and default to all of them.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--iterations', type='int', dest='iterations', default=1000,
+                    help='Number of iterations to average each measurement over.'),
+    )
+
+    def handle(self, *args, **options):
+
+        if args:
+            names = ['denorm.benchmarks.%s' % name for name in args]
+            unknown = set(names) - set(BENCHMARKS)
+            if unknown:
+                raise CommandError('Unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+        else:
+            names = BENCHMARKS
+
+        for name in names:
+            self.stdout.write(name)
+
+            for label, value, unit in import_module(name).run(options['iterations']):
+                self.stdout.write('  %-60s %14.3f %s' % (label, value, unit))
@@ -0,0 +1,34 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from denorm import core, fields, util
+
+class Command(BaseCommand):
+    args = '[<app_label.Model> ...]'
+    help = 'Converts denorm_data of target models to the compact format. Models default to all targets with shared_dict storage.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+                    help='Number of instances to read at a time.'),
+    )
+
+    def handle(self, *args, **options):
+
+        if fields.DATA_FORMAT != 'compact':
+            raise CommandError('settings.DENORM_DATA_FORMAT must be "compact"')
+
+        if args:
+            models = []
+            for name in args:
+                model = util.get_model_by_name(name)
+                if model is None:
+                    raise CommandError('Unknown model: %s' % name)
+                models.append(model)
+        else:
+            models = [model for model, target_plan in core.TARGET_PLANS.iteritems()
+                      if any(source_plan.storage == 'shared_dict' for source_plan in target_plan.sources)]
+
+        for model in models:
+            converted = fields.compact_denorm_data(model, options['batch_size'])
+            self.stdout.write('%s: converted %d instances' % (util.get_model_name(model), converted))
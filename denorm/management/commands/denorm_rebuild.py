@@ -0,0 +1,59 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from denorm import rebuild, receivers, util
+from denorm.strategies import cursor
+
+class Command(BaseCommand):
+    args = '<app_label.Model>'
+    help = 'Rebuilds the denormalized fields of all instances of a target model, resuming an unfinished rebuild.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--source', action='append', dest='sources', default=[],
+                    help='Related field name of a source to rebuild. May be repeated, and defaults to all sources.'),
+        make_option('--shards', type='int', dest='shards', default=receivers.DEFAULT_SHARDS,
+                    help='Number of key range shards of a new rebuild.'),
+        make_option('--concurrency', type='int', dest='concurrency', default=receivers.DEFAULT_SHARDS,
+                    help='Number of shards to rebuild in parallel threads.'),
+        make_option('--page-size', type='int', dest='page_size', default=cursor.ITEMS_PER_TASK,
+                    help='Number of target instances to rebuild at a time.'),
+        make_option('--time-budget', type='float', dest='time_budget', default=None,
+                    help='Seconds after which to stop. Running the command again resumes the rebuild.'),
+        make_option('--restart', action='store_true', dest='restart', default=False,
+                    help='Discard the checkpoints of an unfinished rebuild, and start over.'),
+        make_option('--defer', action='store_true', dest='defer', default=False,
+                    help='Run shards as tasks on the denorm push queue, rather than in this process.'),
+        make_option('--batch-save', action='store_true', dest='batch_save', default=cursor.BATCH_SAVE,
+                    help='Write each page with one batch put rather than a save per changed instance. Depends on the '
+                         'djangoappengine db compiler customization, and defaults to DENORM_CURSOR_BATCH_SAVE.'),
+    )
+
+    def handle(self, *args, **options):
+
+        if len(args) != 1:
+            raise CommandError('Usage: denorm_rebuild %s' % self.args)
+
+        target_model = util.get_model_by_name(args[0])
+        if target_model is None:
+            raise CommandError('Unknown model: %s' % args[0])
+
+        try:
+            unfinished = rebuild.rebuild(target_model,
+                                         sources=options['sources'],
+                                         shards=options['shards'],
+                                         concurrency=options['concurrency'],
+                                         page_size=options['page_size'],
+                                         time_budget=options['time_budget'],
+                                         restart=options['restart'],
+                                         defer=options['defer'],
+                                         batch_save=options['batch_save'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        if options['defer']:
+            self.stdout.write('Deferred %d shards' % len(unfinished))
+        elif unfinished:
+            self.stdout.write('%d shards are unfinished. Run the command again to resume.' % len(unfinished))
+        else:
+            self.stdout.write('Rebuild is complete')
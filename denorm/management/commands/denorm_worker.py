@@ -0,0 +1,33 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from denorm import tasks
+from denorm.worker import Worker
+
+class Command(BaseCommand):
+    help = 'Leases denorm pull tasks continuously, and runs their fan-outs in a process or thread pool until stopped.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--concurrency', type='int', dest='concurrency', default=4,
+                    help='Number of pool processes or threads.'),
+        make_option('--threads', action='store_true', dest='threads', default=False,
+                    help='Run pages in a thread pool instead of a process pool.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+                    help='Number of pull tasks to lease at a time.'),
+        make_option('--lease-seconds', type='int', dest='lease_seconds', default=tasks.LEASE_SECONDS,
+                    help='Seconds after which pull tasks of incomplete fan-outs are leased again.'),
+        make_option('--min-age-seconds', type='float', dest='min_age_seconds', default=1,
+                    help='Seconds to wait for more saves of a source before dispatching its fan-out.'),
+        make_option('--max-backoff-seconds', type='float', dest='max_backoff_seconds', default=5,
+                    help='Longest wait between leases while the queue is empty.'),
+    )
+
+    def handle(self, *args, **options):
+
+        Worker(concurrency=options['concurrency'],
+               threads=options['threads'],
+               batch_size=options['batch_size'],
+               lease_seconds=options['lease_seconds'],
+               min_age_seconds=options['min_age_seconds'],
+               max_backoff_seconds=options['max_backoff_seconds']).run()
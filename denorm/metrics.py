@@ -0,0 +1,217 @@
+#
+# Metrics collectors aggregate the instrumentation signals in denorm.signals per source and target model pair, so that
+# denorm lag, fan-out sizes, merge ratios and page durations can be monitored. Applications may connect their own
+# receivers to the signals instead, or in addition.
+#
+# The collector is chosen with settings.DENORM_METRICS_COLLECTOR, e.g. 'denorm.metrics.CacheMetricsCollector', and
+# collection is disabled by default. Aggregated metrics are served as JSON by denorm_stats_handler.
+#
+
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from mapreduce.util import handler_for_name
+
+from denorm import core, signals, util
+
+METRICS_COLLECTOR = getattr(settings, 'DENORM_METRICS_COLLECTOR', None)
+METRICS_CACHE_PREFIX = getattr(settings, 'DENORM_METRICS_CACHE_PREFIX', 'denorm_metrics')
+METRICS_CACHE_TIMEOUT = getattr(settings, 'DENORM_METRICS_CACHE_TIMEOUT', 7 * 86400)
+
+# metrics recorded by the signal receivers below
+METRIC_NAMES = (
+    'enqueued', 'merged_tasks', 'dispatch_lag',
+    'page_instances', 'page_written', 'page_skipped', 'page_duration',
+    'fan_out_instances', 'fan_out_written', 'fan_out_skipped', 'completion_lag', 'fan_out_duration',
+)
+
+_collector = None
+
+def get_metrics_collector():
+    """
+    Returns the configured metrics collector instance, or None if metrics collection is disabled.
+    """
+    global _collector
+    if _collector is None and METRICS_COLLECTOR:
+        # handler_for_name instantiates the class for us
+        _collector = handler_for_name(METRICS_COLLECTOR)
+    return _collector
+
+class MetricsCollector(object):
+    """
+    Aggregates count, sum, max and last value of each metric per source and target model pair.
+    """
+
+    def get_metrics(self, pair):
+        raise NotImplementedError
+
+    def set_metrics(self, pair, metrics):
+        raise NotImplementedError
+
+    def get_many_metrics(self, pairs):
+        return dict((pair, self.get_metrics(pair)) for pair in pairs)
+
+    def record(self, source_model, target_model, **values):
+
+        pair = (util.get_model_name(source_model), util.get_model_name(target_model))
+        metrics = self.get_metrics(pair) or {}
+
+        for name, value in values.iteritems():
+            if value is None:
+                continue
+
+            aggregate = metrics.setdefault(name, {'count': 0, 'sum': 0, 'max': value, 'last': value})
+            aggregate['count'] += 1
+            aggregate['sum'] += value
+            aggregate['max'] = max(aggregate['max'], value)
+            aggregate['last'] = value
+
+        self.set_metrics(pair, metrics)
+
+    def get_stats(self):
+        """
+        Returns metrics of all registered source and target model pairs, keyed by '<source model> -> <target model>'.
+        """
+
+        pairs = set()
+        for source_plan in core.SOURCE_PLANS.itervalues():
+            for source_field, targets in source_plan.fields:
+                for target in targets:
+                    pairs.add((source_plan.model_name, target.target_model_name))
+
+        stats = {}
+        for pair, metrics in self.get_many_metrics(sorted(pairs)).iteritems():
+            if metrics:
+                stats['%s -> %s' % pair] = dict(
+                    (name, dict(aggregate, avg=float(aggregate['sum']) / aggregate['count'])) for name, aggregate in metrics.iteritems()
+                )
+
+        return stats
+
+class LocalMemoryMetricsCollector(MetricsCollector):
+    """
+    Keeps metrics in process memory. Only complete when a single process does all denorm work, e.g. development server.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def get_metrics(self, pair):
+        with self._lock:
+            return self._metrics.get(pair)
+
+    def set_metrics(self, pair, metrics):
+        with self._lock:
+            self._metrics[pair] = metrics
+
+class CacheMetricsCollector(MetricsCollector):
+    """
+    Keeps metrics in the default Django cache, e.g. memcache, so that they are aggregated across instances. Each
+    aggregate has its own key, and counts and sums are atomically incremented. Concurrent updates of the same maximum
+    may occasionally overwrite each other.
+    """
+
+    # cache increments are integral, so sums of e.g. durations are kept in thousandths
+    SUM_SCALE = 1000
+
+    def _key(self, pair, name, aggregate):
+        return '%s:%s:%s:%s:%s' % ((METRICS_CACHE_PREFIX,) + pair + (name, aggregate))
+
+    def _incr(self, key, delta):
+
+        if cache.add(key, delta, METRICS_CACHE_TIMEOUT):
+            return
+
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            # expired since add
+            cache.set(key, delta, METRICS_CACHE_TIMEOUT)
+
+    def record(self, source_model, target_model, **values):
+
+        pair = (util.get_model_name(source_model), util.get_model_name(target_model))
+        values = dict((name, value) for name, value in values.iteritems() if value is not None)
+
+        for name, value in values.iteritems():
+            self._incr(self._key(pair, name, 'count'), 1)
+            self._incr(self._key(pair, name, 'sum'), int(round(value * self.SUM_SCALE)))
+
+        maximums = cache.get_many([self._key(pair, name, 'max') for name in values])
+
+        updates = {}
+        for name, value in values.iteritems():
+            updates[self._key(pair, name, 'last')] = value
+
+            key = self._key(pair, name, 'max')
+            if key not in maximums or value > maximums[key]:
+                updates[key] = value
+
+        cache.set_many(updates, METRICS_CACHE_TIMEOUT)
+
+    def get_metrics(self, pair):
+        return self.get_many_metrics([pair]).get(pair)
+
+    def get_many_metrics(self, pairs):
+
+        keys = {}
+        for pair in pairs:
+            for name in METRIC_NAMES:
+                for aggregate in ('count', 'sum', 'max', 'last'):
+                    keys[self._key(pair, name, aggregate)] = (pair, name, aggregate)
+
+        many_metrics = {}
+        for key, value in cache.get_many(keys.keys()).iteritems():
+            pair, name, aggregate = keys[key]
+            if aggregate == 'sum':
+                value = float(value) / self.SUM_SCALE
+            many_metrics.setdefault(pair, {}).setdefault(name, {})[aggregate] = value
+
+        # aggregates are evicted independently, so skip incomplete ones
+        return dict(
+            (pair, dict((name, aggregate) for name, aggregate in metrics.iteritems() if len(aggregate) == 4 and aggregate['count']))
+            for pair, metrics in many_metrics.iteritems()
+        )
+
+#
+# signal receivers feeding the configured collector
+#
+
+def _enqueued(sender, source_model, **kwargs):
+    get_metrics_collector().record(source_model, sender, enqueued=1)
+
+def _dispatched(sender, source_model, merged_tasks, lag, **kwargs):
+    get_metrics_collector().record(source_model, sender, merged_tasks=merged_tasks, dispatch_lag=lag)
+
+def _page_written(sender, source_model, instances, skipped, duration, **kwargs):
+    get_metrics_collector().record(source_model, sender, page_instances=instances, page_written=instances - skipped,
+                                   page_skipped=skipped, page_duration=duration)
+
+def _completed(sender, source_model, instances, skipped, lag, duration, **kwargs):
+    get_metrics_collector().record(source_model, sender, fan_out_instances=instances, fan_out_written=instances - skipped,
+                                   fan_out_skipped=skipped, completion_lag=lag, fan_out_duration=duration)
+
+def connect_collector():
+    """
+    Connects the configured collector to the instrumentation signals, unless metrics collection is disabled.
+    """
+
+    if not METRICS_COLLECTOR:
+        return
+
+    # use dispatch_uid to prevent duplicates
+    signals.denorm_enqueued.connect(_enqueued, dispatch_uid='denorm_metrics_enqueued')
+    signals.denorm_dispatched.connect(_dispatched, dispatch_uid='denorm_metrics_dispatched')
+    signals.denorm_page_written.connect(_page_written, dispatch_uid='denorm_metrics_page_written')
+    signals.denorm_completed.connect(_completed, dispatch_uid='denorm_metrics_completed')
+
+@util.require_task_access
+def denorm_stats_handler(request):
+
+    collector = get_metrics_collector()
+    stats = collector.get_stats() if collector else {}
+
+    return HttpResponse(util.dump_json(stats), content_type='application/json')
@@ -34,4 +34,34 @@ class LocalUserMiddleware(object):
 
 def get_current_user():
     current_user = getattr(_thread_locals, USER_ATTR_NAME, None)
-    return current_user() if current_user else current_user
\ No newline at end of file
+    return current_user() if current_user else current_user
+
+#
+# This middleware buffers denorm enqueues of a request, so that multiple saves of the same source get merged into one
+# pull task per target, and all pull tasks and Task rows get written in batches when the request ends.
+#
+
+from denorm import buffering
+
+class DenormBufferMiddleware(object):
+    def process_request(self, request):
+        buffering.begin()
+
+    def process_response(self, request, response):
+        buffering.end()
+        return response
+
+#
+# This middleware caches the source instances that target saves of a request denormalize, so that each source is
+# loaded at most once per request.
+#
+
+from denorm import source_cache
+
+class DenormSourceCacheMiddleware(object):
+    def process_request(self, request):
+        source_cache.begin()
+
+    def process_response(self, request, response):
+        source_cache.end()
+        return response
@@ -38,4 +38,65 @@ class Task(AbstractTask):
     # coming from the ForeignKey fields' reverse relations, which
     # would be duplicate by both this class as well as the custom class.
     class Meta:
-        swappable = 'DENORM_TASK_MODEL'
\ No newline at end of file
+        swappable = 'DENORM_TASK_MODEL'
+
+
+class TaskRollup(models.Model):
+    """
+    Number of tasks per label, source model and hour, rolled up from task rows that are past retention.
+    """
+    label = models.CharField(max_length=500)
+    source_model = models.CharField(max_length=200)
+    hour = models.DateTimeField(db_index=True)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        # overlapping retention runs may roll up the same hour
+        unique_together = [('label', 'source_model', 'hour')]
+
+class QueuedTask(models.Model):
+    """
+    Pull task of denorm.queues.DatabaseQueueBackend. A task is available for lease once its eta has passed, and
+    leasing it moves its eta forward by the lease duration.
+    """
+    queue_name = models.CharField(max_length=100)
+    tag = models.CharField(max_length=500)
+    payload = models.TextField()
+    eta = models.DateTimeField()
+    # set by the lease that claimed the task most recently
+    lease_id = models.CharField(max_length=32, blank=True, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        index_together = [
+            ('queue_name', 'eta'),
+            ('queue_name', 'tag', 'eta'),
+        ]
+
+class RebuildShard(models.Model):
+    """
+    Checkpoint of a key range shard of a denorm_rebuild run, per target model and set of sources. Range bounds and the
+    last rebuilt key are JSON encoded, so that any primary key type can be stored.
+    """
+    target_model = models.CharField(max_length=200)
+    sources = models.CharField(max_length=500) # comma separated related field names
+    index = models.PositiveIntegerField()
+    range_start = models.TextField(blank=True, null=True)
+    range_end = models.TextField(blank=True, null=True)
+    last_pk = models.TextField(blank=True, null=True)
+    instances = models.PositiveIntegerField(default=0)
+    written = models.PositiveIntegerField(default=0)
+    done = models.BooleanField(default=False)
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [('target_model', 'sources', 'index')]
+
+class PayloadValue(models.Model):
+    """
+    Large source field value that task payloads refer to by key, see denorm.payloads.
+    """
+    key = models.CharField(max_length=255, unique=True)
+    value = models.TextField() # JSON encoded
+    # last time a payload was encoded with a reference to the value
+    referenced = models.DateTimeField(db_index=True)
@@ -0,0 +1,203 @@
+#
+# Encoding of pull task payloads, which are also passed on to the push tasks of cursor strategies. Payloads carry the
+# new values of the changed source fields, so large text or JSON fields make them large, and may exceed task size limits.
+#
+# With settings.DENORM_PAYLOAD_REFERENCE_THRESHOLD, field values whose JSON encoding is longer than that many bytes are
+# stored once in a PayloadValue row, keyed by source instance and a hash of the value, and payloads only carry the key.
+# Keys are resolved by the cursor strategy tasks and mapper calls that write the values, so merging, version checks and
+# deferred pages pass the small references around. Rows are deleted DENORM_PAYLOAD_VALUE_RETENTION_SECONDS (one week by
+# default) after they were last referenced, by the cron handler.
+#
+# With settings.DENORM_PAYLOAD_COMPRESS_THRESHOLD, payload strings longer than that many bytes are zlib compressed.
+#
+# Payloads encoded without either setting are plain JSON, and load() reads both, so the settings can be changed while
+# tasks are queued.
+#
+
+from datetime import timedelta
+import base64, hashlib, json, zlib
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from denorm import models, util
+
+PAYLOAD_REFERENCE_THRESHOLD = getattr(settings, 'DENORM_PAYLOAD_REFERENCE_THRESHOLD', None)
+PAYLOAD_COMPRESS_THRESHOLD = getattr(settings, 'DENORM_PAYLOAD_COMPRESS_THRESHOLD', None)
+PAYLOAD_VALUE_RETENTION_SECONDS = getattr(settings, 'DENORM_PAYLOAD_VALUE_RETENTION_SECONDS', 7 * 86400)
+
+COMPRESSED_PREFIX = 'z:'
+
+# a field value that is stored in a PayloadValue row
+REFERENCE_KEY = '__denorm_ref__'
+
+# values of resolved references. rows never change once written, because their keys include a hash of the value.
+MAX_RESOLVED_VALUES = 100
+_resolved = {}
+
+def _reference_fields(payload, values):
+    """
+    Returns fields of payload with values larger than the threshold replaced by references, collecting the referenced
+    values keyed by reference.
+    """
+
+    fields = {}
+
+    for field, value in payload['fields'].iteritems():
+        value_string = util.dump_json(value)
+
+        if len(value_string) > PAYLOAD_REFERENCE_THRESHOLD:
+            key = '%s:%s:%s' % (payload['source_model'], payload['instance_id'], hashlib.sha1(value_string).hexdigest())
+            values[key] = value_string
+            value = {REFERENCE_KEY: key}
+
+        fields[field] = value
+
+    return fields
+
+def _reference_downstream(downstream, source_payload, values):
+
+    specs = []
+
+    for spec in downstream:
+        # downstream fields carry the values of the source payload's fields
+        spec = dict(spec, fields=_reference_fields(dict(spec, source_model=source_payload['source_model'],
+                                                        instance_id=source_payload['instance_id']), values))
+        if spec.get('downstream'):
+            spec['downstream'] = _reference_downstream(spec['downstream'], source_payload, values)
+        specs.append(spec)
+
+    return specs
+
+def _store(values):
+    """
+    Stores referenced values, and marks the rows of values that are already stored as referenced now.
+    """
+
+    now = timezone.now()
+
+    existing = set(models.PayloadValue.objects.filter(key__in=values.keys()).values_list('key', flat=True))
+    if existing:
+        models.PayloadValue.objects.filter(key__in=existing).update(referenced=now)
+
+    missing = [(key, value) for key, value in values.iteritems() if key not in existing]
+    if not missing:
+        return
+
+    # savepoints, so that an IntegrityError does not break an enclosing transaction
+    try:
+        with transaction.atomic():
+            models.PayloadValue.objects.bulk_create([
+                models.PayloadValue(key=key, value=value, referenced=now) for key, value in missing
+            ])
+    except IntegrityError:
+        # some were stored by a concurrent save of the same source value. store the others one at a time.
+        for key, value in missing:
+            try:
+                with transaction.atomic():
+                    models.PayloadValue.objects.create(key=key, value=value, referenced=now)
+            except IntegrityError:
+                models.PayloadValue.objects.filter(key=key).update(referenced=now)
+
+def dump(payload):
+    """
+    Returns the payload string of payload, with large field values referenced and large strings compressed if enabled.
+    """
+
+    if PAYLOAD_REFERENCE_THRESHOLD:
+        values = {}
+
+        payload = dict(payload, fields=_reference_fields(payload, values))
+        if payload.get('downstream'):
+            payload['downstream'] = _reference_downstream(payload['downstream'], payload, values)
+
+        if values:
+            _store(values)
+
+    payload_string = util.dump_json(payload)
+
+    if PAYLOAD_COMPRESS_THRESHOLD and len(payload_string) > PAYLOAD_COMPRESS_THRESHOLD:
+        # base64, so that the payload can be stored as text, e.g. by DatabaseQueueBackend
+        payload_string = COMPRESSED_PREFIX + base64.b64encode(zlib.compress(payload_string))
+
+    return payload_string
+
+def load(payload_string):
+    """
+    Returns the payload of a payload string. Referenced field values are left as references, see resolve().
+    """
+
+    if payload_string.startswith(COMPRESSED_PREFIX):
+        payload_string = zlib.decompress(base64.b64decode(payload_string[len(COMPRESSED_PREFIX):]))
+
+    return json.loads(payload_string)
+
+def _is_reference(value):
+    return isinstance(value, dict) and len(value) == 1 and REFERENCE_KEY in value
+
+def _collect_references(value, keys):
+
+    if _is_reference(value):
+        keys.add(value[REFERENCE_KEY])
+    elif isinstance(value, dict):
+        for item in value.itervalues():
+            _collect_references(item, keys)
+
+def _replace_references(value, resolved):
+
+    if _is_reference(value):
+        return resolved[value[REFERENCE_KEY]]
+    elif isinstance(value, dict):
+        return dict((key, _replace_references(item, resolved)) for key, item in value.iteritems())
+    return value
+
+def resolve_values(values):
+    """
+    Returns values, e.g. payload fields or denorm values, with references replaced by the values they refer to.
+    Raises PayloadValue.DoesNotExist if a referenced value is no longer stored.
+    """
+
+    keys = set()
+    _collect_references(values, keys)
+    if not keys:
+        return values
+
+    resolved = dict((key, _resolved[key]) for key in keys if key in _resolved)
+
+    missing = keys.difference(resolved)
+    if missing:
+        rows = dict(models.PayloadValue.objects.filter(key__in=missing).values_list('key', 'value'))
+        if len(rows) < len(missing):
+            raise models.PayloadValue.DoesNotExist('payload values %s are not stored' % ', '.join(sorted(missing.difference(rows))))
+
+        for key, value in rows.iteritems():
+            resolved[key] = json.loads(value)
+
+        if len(_resolved) + len(rows) > MAX_RESOLVED_VALUES:
+            _resolved.clear()
+        _resolved.update((key, resolved[key]) for key in rows)
+
+    return _replace_references(values, resolved)
+
+def resolve(payload):
+    """
+    Returns payload with its fields resolved. Downstream fields stay referenced, and are resolved by their own fan-outs.
+    """
+
+    fields = resolve_values(payload['fields'])
+    return payload if fields is payload['fields'] else dict(payload, fields=fields)
+
+def delete_unreferenced():
+    """
+    Deletes stored values that no payload was encoded with for the retention period. Returns the number of deleted rows.
+    """
+
+    cutoff = timezone.now() - timedelta(seconds=PAYLOAD_VALUE_RETENTION_SECONDS)
+    queryset = models.PayloadValue.objects.filter(referenced__lt=cutoff)
+
+    count = queryset.count()
+    if count:
+        queryset.delete()
+
+    return count
@@ -0,0 +1,110 @@
+#
+# Bulk propagation of source changes that bypassed the signal receivers, e.g. QuerySet.update(), bulk_create() or raw
+# migrations. propagate() reads the denormalized fields of the sources in a queryset with values_list, so that no
+# instances are built and no receivers run, and enqueues a pull task per source instance and affected target model with
+# the current values. The pull tasks are added per batch of BATCH_SIZE sources, grouped by target model, and join an
+# active write-behind buffer.
+# Unlike source saves, propagation does not create Task rows and is not throttled.
+#
+#   Book.objects.filter(author=author).update(title_prefix='New')
+#   denorm.propagate(Book.objects.filter(author=author), fields=['title_prefix'])
+#
+# Pull tasks carry the same tags as those of source saves, so setup_denorm_task merges them with pending saves of the
+# same source instances. That is why sources are not coalesced into one fan-out per distinct set of values, even if an
+# update() gave many of them the same ones: each fan-out still selects the targets of a single source instance.
+#
+
+import logging
+
+from denorm import buffering, core, receivers
+
+# sources read at a time
+BATCH_SIZE = 500
+
+def _get_targets(source_plan, source_model, fields):
+    """
+    Returns (source field, SourceTargetPlan tuple) pairs of the registered source fields in fields, or of all of them.
+    Like update_fields, fields may name foreign keys by field name or by attname.
+    """
+
+    if fields is None:
+        return source_plan.fields
+
+    attnames = receivers._get_update_attnames(source_model, fields)
+
+    known = set(source_plan.field_names)
+    known.update(field.name for field in source_model._meta.fields if field.attname in source_plan.field_names)
+
+    unknown = set(fields).difference(known)
+    if unknown:
+        raise ValueError('%s has no denormalized fields %s' % (source_plan.model_name, ', '.join(sorted(unknown))))
+
+    return tuple((source_field, targets) for source_field, targets in source_plan.fields if source_field in attnames)
+
+def _enqueue(source_plan, source_model, targets, rows):
+    """
+    Enqueues the pull tasks of a batch of source rows. Returns the number of enqueued pull tasks.
+    """
+
+    # shards functions are called with the source instance, so load instances only if a target needs them
+    if any(target.shards for source_field, target_plans in targets for target in target_plans):
+        source_instances = source_model.objects.in_bulk([row[0] for row in rows])
+    else:
+        source_instances = {}
+
+    pull_tasks = []
+
+    for row in rows:
+        instance_id = row[0]
+
+        affected_targets = {}
+        for (source_field, target_plans), value in zip(targets, row[1:]):
+            for target in target_plans:
+                receivers._add_affected_target(affected_targets, target, value)
+
+        pull_tasks.extend(receivers._get_pull_tasks(source_plan, instance_id, affected_targets,
+                                                    source_instances.get(instance_id)))
+
+    # group pull tasks by target model, so that their batched adds, and the fan-outs dispatched from them, are too
+    pull_tasks.sort(key=lambda pull_task: pull_task[1]['target_model'])
+
+    # joins an active buffer, so that pull tasks merge with those of source saves in the same block
+    buffering.enqueue(pull_tasks, None, None)
+
+    return len(pull_tasks)
+
+def propagate(queryset, fields=None):
+    """
+    Enqueues denormalization of the given source fields, or of all registered source fields, of the source instances in
+    queryset to all of their targets. Returns the number of enqueued pull tasks.
+    """
+
+    source_model = queryset.model._meta.concrete_model
+
+    source_plan = core.SOURCE_PLANS.get(source_model)
+    if source_plan is None:
+        raise ValueError('%s is not a registered denorm source' % source_model.__name__)
+
+    targets = _get_targets(source_plan, source_model, fields)
+    if not targets:
+        return 0
+
+    source_fields = [source_field for source_field, target_plans in targets]
+
+    enqueued = 0
+    rows = []
+
+    # enqueue a batch at a time, so that pull tasks of large querysets are not all held in memory
+    for row in queryset.order_by().values_list('pk', *source_fields).iterator():
+        rows.append(row)
+
+        if len(rows) == BATCH_SIZE:
+            enqueued += _enqueue(source_plan, source_model, targets, rows)
+            rows = []
+
+    if rows:
+        enqueued += _enqueue(source_plan, source_model, targets, rows)
+
+    logging.info('[denorm.propagate] enqueued %d pull tasks for %s' % (enqueued, source_plan.model_name))
+
+    return enqueued
@@ -0,0 +1,165 @@
+#
+# Queue backends hold the pull tasks of source saves until setup_denorm_task leases, merges and dispatches them. Tasks
+# are added as (tag, payload string) pairs, and leased as objects with tag and payload attributes, which are passed
+# back to delete them.
+#
+# The backend is chosen with settings.DENORM_QUEUE_BACKEND. The default TaskQueueBackend uses an App Engine pull queue.
+# DatabaseQueueBackend keeps tasks in the QueuedTask table instead, e.g. to keep pull tasks in an SQL database. Either
+# way, denorm depends on the App Engine SDK, for push tasks, deferred and mapreduce.
+# Queue names are set with DENORM_PULL_QUEUE_NAME and DENORM_PUSH_QUEUE_NAME.
+#
+
+from datetime import timedelta
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from google.appengine.api import taskqueue
+from mapreduce.util import handler_for_name
+
+from denorm import exceptions, models, util
+
+QUEUE_BACKEND = getattr(settings, 'DENORM_QUEUE_BACKEND', 'denorm.queues.TaskQueueBackend')
+
+# pull queue of source saves, and push queue that strategies run fan-outs on
+PULL_QUEUE_NAME = getattr(settings, 'DENORM_PULL_QUEUE_NAME', 'pull-denorm')
+PUSH_QUEUE_NAME = getattr(settings, 'DENORM_PUSH_QUEUE_NAME', 'denorm')
+
+_backend = None
+
+def get_queue_backend():
+    """
+    Returns the configured queue backend instance.
+    """
+    global _backend
+    if _backend is None:
+        # handler_for_name instantiates the class for us
+        _backend = handler_for_name(QUEUE_BACKEND)
+    return _backend
+
+class QueueBackend(object):
+
+    def add(self, tasks):
+        """
+        Adds pull tasks given as (tag, payload string) pairs.
+        """
+        raise NotImplementedError
+
+    def lease(self, lease_seconds, max_tasks):
+        """
+        Leases up to max_tasks available tasks, oldest first. Raises QueueTransientError if leasing may succeed on retry.
+        """
+        raise NotImplementedError
+
+    def lease_by_tag(self, lease_seconds, max_tasks, tag):
+        """
+        Leases up to max_tasks available tasks with tag, oldest first. Raises QueueTransientError like lease.
+        """
+        raise NotImplementedError
+
+    def modify_lease(self, tasks, lease_seconds):
+        """
+        Sets the leases of leased tasks to expire lease_seconds from now, e.g. to extend them while their fan-out runs.
+        Raises QueueTransientError like lease.
+        """
+        raise NotImplementedError
+
+    def delete(self, tasks):
+        """
+        Deletes leased tasks.
+        """
+        raise NotImplementedError
+
+class TaskQueueBackend(QueueBackend):
+    """
+    App Engine pull queue. Operations are batched up to the taskqueue api limits.
+    """
+
+    def _queue(self):
+        return taskqueue.Queue(PULL_QUEUE_NAME)
+
+    def add(self, tasks):
+        q = self._queue()
+        for chunk in util.chunks([taskqueue.Task(payload=payload, tag=tag, method='PULL') for tag, payload in tasks],
+                                 util.MAX_TASKS_PER_ADD):
+            q.add(chunk)
+
+    def lease(self, lease_seconds, max_tasks):
+        try:
+            return self._queue().lease_tasks(lease_seconds, max_tasks)
+        except taskqueue.TransientError as e:
+            raise exceptions.QueueTransientError(e)
+
+    def lease_by_tag(self, lease_seconds, max_tasks, tag):
+        try:
+            return self._queue().lease_tasks_by_tag(lease_seconds, max_tasks, tag) or []
+        except taskqueue.TransientError as e:
+            raise exceptions.QueueTransientError(e)
+
+    def modify_lease(self, tasks, lease_seconds):
+        q = self._queue()
+        try:
+            for task in tasks:
+                # the taskqueue api modifies one lease per call
+                q.modify_task_lease(task, lease_seconds)
+        except taskqueue.TransientError as e:
+            raise exceptions.QueueTransientError(e)
+
+    def delete(self, tasks):
+        q = self._queue()
+        for chunk in util.chunks(tasks, util.MAX_TASKS_PER_LEASE):
+            q.delete_tasks(chunk)
+
+class DatabaseQueueBackend(QueueBackend):
+    """
+    Pull queue in the QueuedTask table. A lease selects available rows, and claims them with one UPDATE, which is
+    conditional on the rows still being available, so that concurrent leases never claim the same rows.
+    """
+
+    # rows per INSERT and DELETE statement, within the query parameter limits of common databases
+    BATCH_SIZE = 500
+
+    def add(self, tasks):
+        now = timezone.now()
+        models.QueuedTask.objects.bulk_create([
+            models.QueuedTask(queue_name=PULL_QUEUE_NAME, tag=tag, payload=payload, eta=now) for tag, payload in tasks
+        ], batch_size=self.BATCH_SIZE)
+
+    def _lease(self, lease_seconds, max_tasks, **filters):
+        now = timezone.now()
+        lease_id = uuid.uuid4().hex
+
+        with transaction.atomic():
+            queryset = models.QueuedTask.objects.filter(queue_name=PULL_QUEUE_NAME, eta__lte=now, **filters)
+
+            ids = list(queryset.order_by('eta', 'id').values_list('id', flat=True)[:max_tasks])
+            if not ids:
+                return []
+
+            models.QueuedTask.objects.filter(id__in=ids, eta__lte=now).update(eta=now + timedelta(seconds=lease_seconds),
+                                                                           lease_id=lease_id)
+
+        return list(models.QueuedTask.objects.filter(lease_id=lease_id).order_by('id'))
+
+    def lease(self, lease_seconds, max_tasks):
+        return self._lease(lease_seconds, max_tasks)
+
+    def lease_by_tag(self, lease_seconds, max_tasks, tag):
+        return self._lease(lease_seconds, max_tasks, tag=tag)
+
+    def modify_lease(self, tasks, lease_seconds):
+        eta = timezone.now() + timedelta(seconds=lease_seconds)
+
+        # only modify leases that are still held, rather than those of tasks another lease has claimed since
+        lease_ids = {}
+        for task in tasks:
+            lease_ids.setdefault(task.lease_id, []).append(task.id)
+
+        for lease_id, ids in lease_ids.iteritems():
+            for chunk in util.chunks(ids, self.BATCH_SIZE):
+                models.QueuedTask.objects.filter(id__in=chunk, lease_id=lease_id).update(eta=eta)
+
+    def delete(self, tasks):
+        for chunk in util.chunks([task.id for task in tasks], self.BATCH_SIZE):
+            models.QueuedTask.objects.filter(id__in=chunk).delete()
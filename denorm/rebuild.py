@@ -0,0 +1,277 @@
+#
+# Rebuild of the denormalized fields of all instances of a target model, e.g. after a source field was added to a
+# registration, or to repair data. Target instances are split into key range shards, which are scanned in key order a
+# page at a time. Each page loads the sources it references with one in_bulk call per registered source, and only
+# writes the target instances whose denormalized values changed. By default, they are saved one at a time, with
+# update_fields if cursor.is_partial() allows it, which costs a write per changed instance. With batch_save, which
+# defaults to DENORM_CURSOR_BATCH_SAVE, each page is written with one batch put, which depends on the djangoappengine db
+# compiler customization that the cursor strategy's batch save uses.
+#
+# Progress is checkpointed in a RebuildShard row per shard after each page, so that a crashed or timed out rebuild
+# resumes where it stopped when it is started again for the same target model and sources. Checkpoints are deleted once
+# all shards are done.
+#
+# Run it with `python manage.py denorm_rebuild <app_label.Model> [--source <related field name> ...]`.
+#
+
+from multiprocessing.pool import ThreadPool
+import json, logging, time
+
+from django.conf import settings
+from django.db import IntegrityError, connections
+from google.appengine.api import datastore
+
+import denorm
+from denorm import buffering, core, models, queues, receivers, util
+from denorm.strategies import cursor
+
+# time budget of a deferred shard task, after which it defers itself to continue
+REBUILD_TIME_BUDGET_SECONDS = getattr(settings, 'DENORM_REBUILD_TIME_BUDGET_SECONDS', 60)
+
+def get_source_plans(target_model, sources=None):
+    """
+    Returns the TargetSourcePlans of target_model with the given related field names, or all of them.
+    """
+
+    target_plan = core.TARGET_PLANS.get(target_model)
+    if target_plan is None:
+        raise ValueError('%s is not a registered denorm target' % target_model.__name__)
+
+    if not sources:
+        return target_plan.sources
+
+    try:
+        return tuple(target_plan.get_source(source) for source in sources)
+    except KeyError as e:
+        raise ValueError('%s has no registered source %s' % (target_plan.model_name, e))
+
+def get_shards(target_model, source_plans, shards=receivers.DEFAULT_SHARDS, restart=False):
+    """
+    Returns the checkpoints of the shards of a rebuild of target_model from source_plans. An unfinished rebuild is
+    resumed unless restart is set, and otherwise target instances are split into up to shards key ranges.
+    """
+
+    model_name = util.get_model_name(target_model)
+    sources = ','.join(sorted(source_plan.source for source_plan in source_plans))
+
+    checkpoints = models.RebuildShard.objects.filter(target_model=model_name, sources=sources)
+
+    if restart:
+        checkpoints.delete()
+    elif checkpoints.exists():
+        logging.info('[denorm.rebuild.get_shards] resume rebuild of %s from %s' % (model_name, sources))
+        return list(checkpoints.order_by('index'))
+
+    # like sharded_cursor, split at the keys at evenly spaced offsets in key order, and leave outer ranges open ended
+    keys = target_model.objects.order_by('pk').values_list('pk', flat=True)
+    count = keys.count()
+
+    shards = max(1, min(shards, (count + cursor.ITEMS_PER_TASK - 1) / cursor.ITEMS_PER_TASK))
+    boundaries = [None] + [keys[count * i / shards] for i in xrange(1, shards)] + [None]
+
+    try:
+        models.RebuildShard.objects.bulk_create([
+            models.RebuildShard(target_model=model_name, sources=sources, index=index,
+                                range_start=util.dump_json(range_start) if range_start is not None else None,
+                                range_end=util.dump_json(range_end) if range_end is not None else None)
+            for index, (range_start, range_end) in enumerate(zip(boundaries[:-1], boundaries[1:]))
+        ])
+    except IntegrityError:
+        # another run of the same rebuild created its shards first
+        pass
+
+    logging.info('[denorm.rebuild.get_shards] split %d instances of %s into %d shards' % (count, model_name, shards))
+
+    return list(checkpoints.order_by('index'))
+
+def _get_denorm_values(source_plans, items):
+    """
+    Returns the denorm values of each item, keyed like _denorm_values, with the sources of all items loaded by one
+    in_bulk call per source.
+    """
+
+    values = dict((item, {}) for item in items)
+
+    for source_plan in source_plans:
+        source_manager = source_plan.source_model.objects
+
+        if source_plan.storage == 'scalar':
+            source_pks = set(getattr(item, source_plan.attname) for item in items)
+            source_pks.discard(None)
+            source_instances = source_manager.in_bulk(list(source_pks))
+
+            for item in items:
+                source_pk = getattr(item, source_plan.attname)
+                source_instance = source_instances.get(source_pk)
+
+                if source_pk is not None and source_instance is None:
+                    # like target saves, leave fields of missing sources alone
+                    continue
+
+                for field, target_field_name in source_plan.target_field_names:
+                    values[item][target_field_name] = getattr(source_instance, field) if source_instance else None
+
+        else:
+            list_fields = dict((item, getattr(item, source_plan.list_field_name) or []) for item in items)
+            source_instances = source_manager.in_bulk(list(set(pk for pks in list_fields.itervalues() for pk in pks)))
+
+            for item in items:
+                # denorm_data keys are strings, b/c they are dumped into json string
+                entries = dict(
+                    (str(source_pk), dict((field, getattr(source_instances[source_pk], field)) for field in source_plan.field_names))
+                    for source_pk in list_fields[item] if source_pk in source_instances
+                )
+                values[item].setdefault('denorm_data', {})[source_plan.list_field_name] = entries
+
+    return values
+
+def _is_rebuilt(item, denorm_values):
+    """
+    Returns whether item already holds denorm_values, including no entries of sources that were removed.
+    """
+
+    for field_name, value in denorm_values.iteritems():
+        if field_name == 'denorm_data':
+            denorm_data = getattr(item, 'denorm_data', None) or {}
+            for list_field_name, entries in value.iteritems():
+                if (denorm_data.get(list_field_name) or {}) != entries:
+                    return False
+
+        elif getattr(item, field_name) != value:
+            return False
+
+    return True
+
+def _rebuild_page(source_plans, items, partial, batch_save):
+    """
+    Writes the rebuilt denorm values of a page of target instances. Returns the number of written instances.
+    """
+
+    # if instances were loaded with only(), their signals are sent by a deferred subclass of the target model
+    denorm.connect_deferred(items)
+
+    values = _get_denorm_values(source_plans, items)
+    items = [item for item in items if not _is_rebuilt(item, values[item])]
+
+    for item in items:
+        denorm_values = item._denorm_values = values[item]
+
+        if 'denorm_data' in denorm_values:
+            # pre_save merges entries into denorm_data, so clear the rebuilt lists to drop entries of removed sources
+            item.denorm_data = dict(item.denorm_data or {}, **dict((name, {}) for name in denorm_values['denorm_data']))
+
+    # saves of targets that are in turn sources enqueue their pull tasks in one batch
+    with buffering.coalesce():
+        if batch_save:
+            if items:
+                datastore.Put([util.batch_save(item).entity for item in items])
+        else:
+            for item in items:
+                item.save(update_fields=item._denorm_values.keys() if partial else None)
+
+    return len(items)
+
+def rebuild_shard(shard_id, page_size=cursor.ITEMS_PER_TASK, time_budget=None, batch_save=cursor.BATCH_SAVE):
+    """
+    Rebuilds pages of a shard from its checkpoint until it is done, or time_budget seconds are spent. Pages are written
+    with one batch put if batch_save is set. Returns whether the shard is done.
+    """
+
+    start = time.time()
+
+    shard = models.RebuildShard.objects.get(pk=shard_id)
+    target_model = util.get_model_by_name(shard.target_model)
+    source_plans = get_source_plans(target_model, shard.sources.split(','))
+
+    update_fields = set()
+    for source_plan in source_plans:
+        if source_plan.storage == 'scalar':
+            update_fields.update(target_field_name for field, target_field_name in source_plan.target_field_names)
+        else:
+            update_fields.add('denorm_data')
+
+    queryset = target_model.objects.order_by('pk')
+    if shard.range_start is not None:
+        queryset = queryset.filter(pk__gte=json.loads(shard.range_start))
+    if shard.range_end is not None:
+        queryset = queryset.filter(pk__lt=json.loads(shard.range_end))
+    # a batch put writes whole entities, so they must be loaded whole
+    partial = not batch_save and cursor.is_partial(target_model)
+    if partial:
+        queryset = queryset.only(*cursor.get_load_field_names(target_model, update_fields))
+
+    while not shard.done and not (time_budget and time.time() - start >= time_budget):
+
+        page_queryset = queryset
+        if shard.last_pk is not None:
+            page_queryset = page_queryset.filter(pk__gt=json.loads(shard.last_pk))
+
+        items = list(page_queryset[:page_size])
+
+        shard.written += _rebuild_page(source_plans, items, partial, batch_save)
+        shard.instances += len(items)
+        if items:
+            shard.last_pk = util.dump_json(items[-1].pk)
+        shard.done = len(items) < page_size
+
+        # checkpoint after writing, so that a page is at worst rebuilt again, which then writes nothing
+        shard.save()
+
+    logging.info('[denorm.rebuild.rebuild_shard] shard %d of %s from %s: %d instances, %d written%s' % (
+        shard.index, shard.target_model, shard.sources, shard.instances, shard.written, ', done' if shard.done else ''))
+
+    if shard.done:
+        _finish(shard)
+
+    return shard.done
+
+def _finish(shard):
+
+    checkpoints = models.RebuildShard.objects.filter(target_model=shard.target_model, sources=shard.sources)
+
+    if not checkpoints.filter(done=False).exists():
+        logging.info('[denorm.rebuild] rebuild of %s from %s is complete' % (shard.target_model, shard.sources))
+        checkpoints.delete()
+
+def rebuild_shard_task(shard_id, page_size=cursor.ITEMS_PER_TASK, batch_save=cursor.BATCH_SAVE):
+    """
+    Deferred task of a shard, which defers itself to continue once its time budget is spent.
+    """
+
+    if not rebuild_shard(shard_id, page_size, REBUILD_TIME_BUDGET_SECONDS, batch_save):
+        util.defer(rebuild_shard_task, shard_id, page_size, batch_save, _queue=queues.PUSH_QUEUE_NAME)
+
+def _run_shard(args):
+
+    try:
+        return rebuild_shard(*args)
+    finally:
+        # database connections are per thread
+        for connection in connections.all():
+            connection.close()
+
+def rebuild(target_model, sources=None, shards=receivers.DEFAULT_SHARDS, concurrency=1, page_size=cursor.ITEMS_PER_TASK,
+            time_budget=None, restart=False, defer=False, batch_save=cursor.BATCH_SAVE):
+    """
+    Rebuilds the denormalized fields of all instances of target_model from the sources with the given related field
+    names, or all of them, resuming an unfinished rebuild unless restart is set. Shards run in a pool of concurrency
+    threads for up to time_budget seconds, or, if defer is set, as tasks on the denorm push queue. Pages are written with
+    one batch put if batch_save is set. Returns the unfinished shards.
+    """
+
+    checkpoints = [shard for shard in get_shards(target_model, get_source_plans(target_model, sources), shards, restart)
+                   if not shard.done]
+
+    if defer:
+        for shard in checkpoints:
+            util.defer(rebuild_shard_task, shard.id, page_size, batch_save, _queue=queues.PUSH_QUEUE_NAME)
+        return checkpoints
+
+    pool = ThreadPool(max(1, min(concurrency, len(checkpoints))))
+    try:
+        done = pool.map(_run_shard, [(shard.id, page_size, time_budget, batch_save) for shard in checkpoints])
+    finally:
+        pool.close()
+        pool.join()
+
+    return [shard for shard, shard_done in zip(checkpoints, done) if not shard_done]
@@ -1,20 +1,44 @@
 
-from datetime import timedelta
 import json, logging
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils import timezone
-from google.appengine.api import taskqueue
-from inflector.inflector import Inflector
 from mapreduce.util import handler_for_name
 
-from denorm import core, exceptions, middleware, models, signals, util
+from denorm import buffering, core, exceptions, middleware, queues, signals, source_cache, throttling, versions
+from denorm.fields import has_denorm_data
+
+# in lazy snapshot mode, post_init only takes a shallow copy of the instance __dict__, and original values are looked up
+# in it when the instance actually gets saved. this keeps the cost of loading instances that never get saved low.
+LAZY_SNAPSHOTS = getattr(settings, 'DENORM_LAZY_SNAPSHOTS', False)
+
+# original value of a field that was deferred when the instance was loaded
+DEFERRED = object()
+
+def _snapshot(instance):
+
+    orig_dict = instance.__dict__.copy()
+    # don't chain snapshots of repeatedly saved instances
+    orig_dict.pop('_denorm_orig_dict', None)
+    instance._denorm_orig_dict = orig_dict
+
+def _get_orig_values(instance, key_attnames, eager_attr):
+    """
+    Returns original values keyed like the eager snapshot stored in eager_attr, given (key, attname) pairs.
+    """
+
+    orig_dict = instance.__dict__.get('_denorm_orig_dict')
+    if orig_dict is None:
+        return getattr(instance, eager_attr, {})
+
+    return dict((key, orig_dict.get(attname, DEFERRED)) for key, attname in key_attnames)
 
 def target_model_post_init(sender, instance, **kwargs):
 
-    # for clarity
-    target_model = sender
+    # for clarity. sender is a deferred subclass of the target model for instances loaded with only() or defer().
+    target_model = sender._meta.concrete_model
     target_instance = instance
     created = not target_instance.id
 
@@ -26,26 +50,29 @@ def target_model_post_init(sender, instance, **kwargs):
     if created:
         return
 
-    target_instance._denorm_orig_sources = orig_sources = getattr(target_instance, '_denorm_orig_sources', {})
+    if LAZY_SNAPSHOTS:
+        _snapshot(target_instance)
 
-    target_graph = core.TARGET_GRAPH[target_model]
+        # copy list fields, so that changing them in place does not change the snapshot
+        orig_dict = target_instance._denorm_orig_dict
+        for source_plan in core.TARGET_PLANS[target_model].sources:
+            if isinstance(orig_dict.get(source_plan.list_field_name), list):
+                orig_dict[source_plan.list_field_name] = list(orig_dict[source_plan.list_field_name])
 
-    for source_field, target_data in target_graph.iteritems():
+        return
 
-        storage = target_data['storage']
+    target_instance._denorm_orig_sources = orig_sources = getattr(target_instance, '_denorm_orig_sources', {})
 
-        if storage == 'scalar':
-            orig_sources[source_field] = getattr(target_instance, source_field + '_id')
-        else:
-            # Do we need to track this since we iterate dictionary?
-            assert(storage == 'shared_dict')
-            source_list_field = Inflector().pluralize(source_field)
-            orig_sources[source_list_field] = getattr(target_instance, source_list_field)
+    # scalar storage tracks foreign key attname keyed by source field, and shared_dict storage tracks a copy of the list
+    # field, so that pre_save can skip lists that did not change
+    for key, attname in core.TARGET_PLANS[target_model].orig_source_attnames:
+        value = getattr(target_instance, attname)
+        orig_sources[key] = list(value) if isinstance(value, list) else value
 
 def target_model_pre_save(sender, instance, raw, using, update_fields, **kwargs):
 
     # for clarity
-    target_model = sender
+    target_model = sender._meta.concrete_model
     target_instance = instance
     created = not target_instance.id
 
@@ -55,6 +82,10 @@ def target_model_pre_save(sender, instance, raw, using, update_fields, **kwargs)
     if denorm_values:
 
         for field_name, field_value in denorm_values.iteritems():
+            if update_fields is not None and field_name not in update_fields:
+                # field is not written by this save
+                continue
+
             if field_name == 'denorm_data':
                 denorm_data = target_instance.denorm_data = getattr(target_instance, 'denorm_data', None) or {}
 
@@ -71,63 +102,87 @@ def target_model_pre_save(sender, instance, raw, using, update_fields, **kwargs)
         #
 
         force_denorm = getattr(target_instance, '_force_denorm', False)
-        orig_sources = getattr(target_instance, '_denorm_orig_sources', {})
+        target_plan = core.TARGET_PLANS[target_model]
+        orig_sources = _get_orig_values(target_instance, target_plan.orig_source_attnames, '_denorm_orig_sources')
 
-        target_graph = core.TARGET_GRAPH[target_model]
+        for source_plan in target_plan.sources:
 
-        for source_field, target_data in target_graph.iteritems():
+            source_field = source_plan.source
+            fields = source_plan.field_names
 
-            storage = target_data['storage']
-            fields = target_data['fields']
+            if source_plan.storage == 'scalar':
 
-            if storage == 'scalar':
+                if update_fields is not None and \
+                        not any(target_field_name in update_fields for field, target_field_name in source_plan.target_field_names):
+                    # none of the denormalized fields is written by this save
+                    continue
 
-                source_pk = getattr(target_instance,  source_field + '_id')
+                source_pk = getattr(target_instance, source_plan.attname)
 
                 if force_denorm or created or source_pk != orig_sources[source_field]:
 
                     try:
-                        source_instance = getattr(target_instance,  source_field)
+                        source_instance = source_cache.get_source(target_instance, source_plan)
                     except ObjectDoesNotExist:
                         # uh oh, let's skip it
                         continue
 
-                    for field in fields:
+                    for field, target_field_name in source_plan.target_field_names:
                         source_field_value = getattr(source_instance, field) if source_instance else None
-                        setattr(target_instance, '%s_%s' % (source_field, field), source_field_value)
+                        setattr(target_instance, target_field_name, source_field_value)
 
             else:
-                assert(storage == 'shared_dict')
+                assert(source_plan.storage == 'shared_dict')
+
+                if update_fields is not None and 'denorm_data' not in update_fields:
+                    continue
 
-                source_model = target_data['source_model']
+                source_model = source_plan.source_model
 
-                source_list_field_name = Inflector().pluralize(source_field)
+                source_list_field_name = source_plan.list_field_name
                 source_list_field = getattr(target_instance, source_list_field_name) or []
 
+                # compare with the snapshot before touching denorm_data, so that a compact denorm_data is neither
+                # decoded nor written back re-encoded by saves that do not change the list
+                if not (force_denorm or created) and orig_sources.get(source_list_field_name, DEFERRED) == source_list_field and \
+                        has_denorm_data(target_instance, source_list_field_name):
+                    # list did not change since instance was loaded, so neither did its entries
+                    continue
+
                 denorm_data = target_instance.denorm_data = target_instance.denorm_data or {}
-                source_denorm_data = denorm_data.get(source_list_field_name) or {}
-                source_denorm_keys = source_denorm_data.keys()
 
-                # we'll build up new_source_denorm_data as we iterate the list field
-                denorm_data[source_list_field_name] = new_source_denorm_data = {}
+                # update entries in place, only touching those of added and removed sources
+                source_denorm_data = denorm_data[source_list_field_name] = denorm_data.get(source_list_field_name) or {}
+
+                # convert pk to string b/c denorm_data keys are converted to string when dumped into json string
+                source_pks = set(str(pk) for pk in source_list_field)
 
-                # when iterating source list, convert pk to string b/c denorm_data keys are converted to string when
-                # dumped into json string
-                for source_pk in map(lambda pk: str(pk), source_list_field):
-                    if force_denorm or created or source_pk not in source_denorm_keys:
-                        # TODO: do we want to allow target model to provide any possibly already-loaded source instances to avoid extra lookups?
-                        source_instance = source_model.objects.get(id=source_pk)
+                for source_pk in [source_pk for source_pk in source_denorm_data if source_pk not in source_pks]:
+                    del source_denorm_data[source_pk]
 
-                        source_denorm_values = {}
-                        for field in fields:
-                            # FIXME: it looks like we won't prepend source field name to beginning of key here.
-                            # FIXME: but are we doing that consistently for shared_dict?
-                            source_denorm_values[field] = getattr(source_instance, field)
+                if force_denorm or created:
+                    missing_pks = source_pks
+                else:
+                    missing_pks = source_pks.difference(source_denorm_data)
 
-                    else:
-                        source_denorm_values = source_denorm_data[source_pk]
+                if not missing_pks:
+                    continue
 
-                    new_source_denorm_data[source_pk] = source_denorm_values
+                # load all missing sources with a single batch lookup, unless they are in the active source cache
+                source_instances = source_cache.in_bulk(source_model, missing_pks)
+
+                for source_pk, source_instance in source_instances.iteritems():
+                    source_denorm_values = {}
+                    for field in fields:
+                        # FIXME: it looks like we won't prepend source field name to beginning of key here.
+                        # FIXME: but are we doing that consistently for shared_dict?
+                        source_denorm_values[field] = getattr(source_instance, field)
+
+                    source_denorm_data[str(source_pk)] = source_denorm_values
+
+                if len(source_instances) < len(missing_pks):
+                    logging.warning('[denorm.target_model_pre_save] %s sources %s of %s do not exist' % (
+                        source_plan.source, ', '.join(missing_pks.difference(str(pk) for pk in source_instances)), target_instance))
 
     # fire a post_denorm signal that receivers can listen to in order to any custom follow-up processing before instance is saved
     signals.post_denorm.send(sender=target_model, instance=target_instance)
@@ -135,7 +190,7 @@ def target_model_pre_save(sender, instance, raw, using, update_fields, **kwargs)
 def target_model_post_save(sender, instance, created, **kwargs):
 
     # for clarity
-    target_model = sender
+    target_model = sender._meta.concrete_model
     target_instance = instance
 
     # re-run post_init to reset _denorm_orig_sources in case this instance gets saved again
@@ -143,23 +198,64 @@ def target_model_post_save(sender, instance, created, **kwargs):
 
 def source_model_post_init(sender, instance, **kwargs):
 
-    # for clarity
-    source_model = sender
+    # for clarity. sender is a deferred subclass of the source model for instances loaded with only() or defer().
+    source_model = sender._meta.concrete_model
     source_instance = instance
 
     # keep state of original value for all field values that have denorm dependencies
 
-    source_graph_fields = core.SOURCE_GRAPH[source_model]['fields']
+    if LAZY_SNAPSHOTS:
+        _snapshot(source_instance)
+        return
 
     source_instance._denorm_orig_values = orig_values = getattr(source_instance, '_denorm_orig_values', {})
 
-    for source_field in source_graph_fields:
+    for source_field in core.SOURCE_PLANS[source_model].field_names:
         orig_values[source_field] = getattr(source_instance, source_field)
 
+def _add_affected_target(affected_targets, target, new_value):
+    """
+    Adds the new value of a source field to the fan-out of one of its targets in affected_targets, keyed by target model.
+    """
+
+    target_model = target.target_model
+
+    affected_target = affected_targets.get(target_model)
+    if affected_target is None:
+        affected_target = affected_targets[target_model] = {
+            'related': target.source,
+            'target_model_name': target.target_model_name,
+            'strategy': target.strategy,
+            'storage': target.storage,
+            'shards': target.shards,
+            'min_page_size': target.min_page_size,
+            'max_page_size': target.max_page_size,
+            'lane': target.lane,
+            'chained': False,
+            'fields': {}
+        }
+
+    affected_target['chained'] = affected_target['chained'] or target.chained
+
+    # when task will update target, if storage is scalar, then field name is simply target model field name.
+    # and if storage is shared_dict, then the field name is the dictionary key of the target model's denorm_data field.
+    affected_target['fields'][target.target_field_name] = new_value
+
+def _get_update_attnames(model, update_fields):
+    """
+    Returns the attnames of the fields written by a save with update_fields, which may name foreign keys by field name
+    or by attname, or None if the save writes all fields.
+    """
+
+    if update_fields is None:
+        return None
+
+    return {field.attname for field in model._meta.fields if field.name in update_fields or field.attname in update_fields}
+
 def source_model_pre_save(sender, instance, raw, using, update_fields, **kwargs):
 
     # for clarity
-    source_model = sender
+    source_model = sender._meta.concrete_model
     source_instance = instance
     created = not source_instance.id
 
@@ -173,40 +269,42 @@ def source_model_pre_save(sender, instance, raw, using, update_fields, **kwargs)
     if not getattr(source_instance, '_denorm', True):
         return
 
-    source_graph = core.SOURCE_GRAPH[source_model]
+    source_plan = core.SOURCE_PLANS[source_model]
 
     #
     # iterate through all fields to build up set of distinct affected targets that post_save signal receiver will process.
     #
 
-    source_graph_fields = source_graph['fields']
-    orig_values = source_instance._denorm_orig_values
+    orig_values = _get_orig_values(source_instance, source_plan.orig_value_attnames, '_denorm_orig_values')
+
+    # source fields are attnames, e.g. save(update_fields=['employer']) writes employer_id
+    update_attnames = _get_update_attnames(source_model, update_fields)
+
+    # targets which are written by the downstream fan-out of a chained denormalization that is writing this instance
+    planned = getattr(source_instance, '_denorm_planned', None)
+
+    for source_field, targets in source_plan.fields:
 
-    for source_field, targets in source_graph_fields.iteritems():
+        if update_attnames is not None and source_field not in update_attnames:
+            # field is not written by this save, so its stored value does not change
+            continue
 
         old_value = orig_values[source_field]
+
+        if old_value is DEFERRED and source_field not in source_instance.__dict__:
+            # field was deferred when loaded and has not been loaded or set since, so it is unchanged
+            continue
+
         new_value = getattr(source_instance, source_field)
 
         if old_value != new_value:
             #logging.info('[%s] %s value changed from "%s" to "%s"' % (source_model, source_field, old_value, new_value))
 
             for target in targets:
-                target_model = target['target_model']
-                related_field_name = target['source']
-                storage = target['storage']
-
-                affected_targets[target_model] = affected_target = affected_targets.get(target_model, {
-                    'related': related_field_name,
-                    'strategy': target['strategy'],
-                    'storage': storage,
-                    'shards': target['shards'],
-                    'fields': {}
-                })
+                if planned and (source_field, target.target_model_name) in planned:
+                    continue
 
-                # when task will update target, if storage is scalar, then field name is simply target model field name.
-                # and if storage is shared_dict, then the field name is the dictionary key of the target model's denorm_data field.
-                affected_fields_for_target = affected_target['fields']
-                affected_fields_for_target['%s_%s' % (related_field_name, source_field)] = new_value
+                _add_affected_target(affected_targets, target, new_value)
 
     if not affected_targets:
         return
@@ -224,20 +322,20 @@ def source_model_pre_save(sender, instance, raw, using, update_fields, **kwargs)
 
     # get denorm label used for throttling
 
-    if 'label' in source_graph:
+    if source_plan.label:
         # custom label set by application
-        label = source_graph['label'](source_instance, user)
+        label = source_plan.label(source_instance, user)
     else:
         # default label
         if user:
-            label = '%s_%s' % (util.get_model_name(source_model), str(user.id))
+            label = '%s_%s' % (source_plan.model_name, str(user.id))
         else:
             # no label
             label = None
 
     source_instance._denorm_label = label
 
-    throttles = source_graph.get('throttles')
+    throttles = source_plan.throttles
 
     if not label or not throttles:
         # no throttling
@@ -247,32 +345,64 @@ def source_model_pre_save(sender, instance, raw, using, update_fields, **kwargs)
     # FIXME: we need to figure out if there is already a denorm task scheduled, and if so, then don't penalize throttle.
     # FIXME: perhaps we can use a Task.status field in combination with filter for source instance id.
 
-    now = timezone.now()
+    # Task rows of a write-behind buffer are only recorded when it is flushed, so count them here
+    if throttling.get_throttle_backend().is_throttled(label, throttles, buffering.get_pending_times(label)):
+        raise exceptions.DenormThrottled
 
-    for throttle in throttles:
-        num_requests, duration = util.parse_rate(throttle)
+# chains of denormalized fields deeper than this are propagated by cascading source saves beyond this depth
+MAX_CHAIN_DEPTH = 5
 
-        # FIXME: this is a naive, inefficient implementation. we should cache task counts.
-        if models.get_task_model().objects.filter(label=label, created__gt=now - timedelta(seconds=duration)).count() >= num_requests:
-            raise exceptions.DenormThrottled
+def _get_downstream(target_model, fields, depth=1):
+    """
+    Returns the fan-outs to targets of target_model that denormalize some of the given fields, keyed by attname, so that
+    they can be written by the same fan-out as target_model rather than by a cascade of target_model source saves.
+    Only scalar storage targets are included, because they can be looked up by foreign key.
+    """
 
-DEFAULT_MAP_REDUCE_SHARDS = 3
+    source_plan = core.SOURCE_PLANS.get(target_model)
+    if source_plan is None or depth > MAX_CHAIN_DEPTH:
+        return []
 
-def source_model_post_save(sender, instance, created, **kwargs):
+    downstream = {} # (target model, related field name) => fan-out
 
-    # for clarity
-    source_model = sender
-    source_instance = instance
+    for source_field, targets in source_plan.fields:
+        if source_field not in fields:
+            continue
 
-    affected_targets = source_instance._denorm_affected_targets
+        for target in targets:
+            if target.storage != 'scalar':
+                continue
 
-    if not affected_targets:
-        # nothing to denorm
-        return
+            spec = downstream.get((target.target_model, target.source))
+            if spec is None:
+                spec = downstream[(target.target_model, target.source)] = {
+                    'target_model': target.target_model_name,
+                    'related_field': target.source,
+                    'storage': target.storage,
+                    'fields': {}
+                }
+            spec['fields'][target.target_field_name] = fields[source_field]
 
-    #
-    # create a task for each affected target to update its instances
-    #
+    for (downstream_model, related_field_name), spec in downstream.iteritems():
+        nested = _get_downstream(downstream_model, spec['fields'], depth + 1)
+        if nested:
+            spec['downstream'] = nested
+
+    return downstream.values()
+
+# shards of mapreduce and sharded_cursor strategies, unless registration configures a shards function
+DEFAULT_SHARDS = 3
+
+def _get_pull_tasks(source_plan, instance_id, affected_targets, source_instance=None):
+    """
+    Returns a (tag, payload) pull task per target model in affected_targets for a save of the source instance with
+    instance_id. source_instance is only needed for targets that are registered with a shards function.
+    """
+
+    pull_tasks = []
+
+    # one version per source save, shared by its pull tasks
+    version = versions.next_version(source_plan.model_name, instance_id) if versions.VERSION_STAMPS else None
 
     for target_model, affected_target in affected_targets.iteritems():
 
@@ -287,40 +417,76 @@ def source_model_post_save(sender, instance, created, **kwargs):
 
         # for each affected target, create a separate task
 
-        instance_id = source_instance.id
-        tag = 'DENORM_SOURCE_%s_%s_TARGET_%s' % (util.get_model_name(source_model), instance_id, util.get_model_name(target_model))
+        tag = 'DENORM_SOURCE_%s_%s_TARGET_%s' % (source_plan.model_name, instance_id, affected_target['target_model_name'])
         payload = {
             'created': timezone.now().isoformat(),
             'strategy': strategy,
             'storage': storage,
             'instance_id': instance_id,
-            'source_model': util.get_model_name(source_model),
-            'target_model': util.get_model_name(target_model),
+            'source_model': source_plan.model_name,
+            'target_model': affected_target['target_model_name'],
             'related_field': related_field_name,
             'fields': affected_fields,
-            # TODO: queue name should be configurable
-            'queue_name': 'denorm'
+            'queue_name': queues.PUSH_QUEUE_NAME
         }
 
-        if strategy == 'mapreduce':
-            payload['shards'] = handler_for_name(shards)(source_instance) if shards else DEFAULT_MAP_REDUCE_SHARDS
+        if version:
+            payload['version'] = version
+
+        for bound in ('min_page_size', 'max_page_size'):
+            if affected_target[bound]:
+                payload[bound] = affected_target[bound]
+
+        # a pinned lane is not routed by fan-out size at dispatch
+        if affected_target['lane']:
+            payload['lane'] = payload['queue_name'] = affected_target['lane']
+
+        if strategy in ('mapreduce', 'sharded_cursor'):
+            payload['shards'] = handler_for_name(shards)(source_instance) if shards else DEFAULT_SHARDS
+
+        # cursor strategies write targets of chained targets in the same fan-out. mapreduce leaves them to cascade.
+        if affected_target['chained'] and strategy != 'mapreduce':
+            downstream = _get_downstream(target_model, affected_fields)
+            if downstream:
+                payload['downstream'] = downstream
 
-        payload_string = util.dump_json(payload)
+        # a pull task per target
+        pull_tasks.append((tag, payload))
+
+    return pull_tasks
+
+def source_model_post_save(sender, instance, created, **kwargs):
+
+    # for clarity
+    source_model = sender._meta.concrete_model
+    source_instance = instance
+
+    # targets saved after this source get its new values
+    source_cache.add(source_model, source_instance)
+
+    affected_targets = source_instance._denorm_affected_targets
+
+    if not affected_targets:
+        # nothing to denorm
+        return
+
+    source_plan = core.SOURCE_PLANS[source_model]
+
+    #
+    # create a task for each affected target to update its instances
+    #
 
-        logging.info('[denorm source_model_post_save] queue task payload = %s' % payload_string)
+    pull_tasks = _get_pull_tasks(source_plan, source_instance.id, affected_targets, source_instance)
 
-        # create a pull task per target
-        taskqueue.Queue('pull-denorm').add(
-            taskqueue.Task(payload=payload_string, tag=tag, method='PULL')
-        )
+    # and ** one ** Task model instance used to track denorm tasks per source, particularly for throttling
+    task_row = {
+        'source_model': source_plan.model_name,
+        'source_instance_id': source_instance.id,
+        'user': source_instance._denorm_user,
+        'label': source_instance._denorm_label
+    }
 
-    # create ** one ** Task model instance used to track denorm tasks per source, particularly for throttling
-    models.get_task_model().objects.create(
-        source_model=util.get_model_name(source_model),
-        source_instance_id=source_instance.id,
-        user=source_instance._denorm_user,
-        label=source_instance._denorm_label
-    )
+    buffering.enqueue(pull_tasks, task_row, source_plan.throttles)
 
     # re-run post_init to reset _denorm_orig_values in case this instance gets saved again
     source_model_post_init(source_model, source_instance)
\ No newline at end of file
@@ -0,0 +1,127 @@
+#
+# Retention job for the task tracking table. Task rows are only needed for throttling, so rows older than the longest
+# configured throttle window (or settings.DENORM_TASK_RETENTION_SECONDS, if longer) are rolled up into per-label,
+# per-hour TaskRollup rows and then deleted in batches.
+#
+# The job works one hour at a time, oldest first, within a time budget. It keeps no state besides the tables, so an
+# interrupted run is simply resumed by the next one. Set DENORM_TASK_RETENTION = True to run it from the cron handler.
+#
+
+from datetime import timedelta
+import logging, time
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from djangoappengine.db.utils import get_cursor, set_cursor
+
+from denorm import core, models, util
+
+RETENTION = getattr(settings, 'DENORM_TASK_RETENTION', False)
+RETENTION_SECONDS = getattr(settings, 'DENORM_TASK_RETENTION_SECONDS', 86400)
+RETENTION_TIME_BUDGET_SECONDS = getattr(settings, 'DENORM_TASK_RETENTION_TIME_BUDGET_SECONDS', 20)
+ROLLUP_BATCH_SIZE = 1000
+DELETE_BATCH_SIZE = 500
+
+def get_retention_seconds():
+
+    durations = [RETENTION_SECONDS]
+
+    for source_plan in core.SOURCE_PLANS.itervalues():
+        for throttle in source_plan.throttles:
+            num_requests, duration = util.parse_rate(throttle)
+            durations.append(duration)
+
+    return max(durations)
+
+def _floor_hour(dt):
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+def _rollup(hour, bucket, deadline):
+    """
+    Counts the task rows of an hour in batches, and writes their rollups. Returns False without writing any if the
+    deadline passed before all rows were counted.
+    """
+
+    counts = {}
+    cursor = None
+
+    while True:
+        if time.time() >= deadline:
+            return False
+
+        rows = bucket.values_list('label', 'source_model')
+        if cursor:
+            rows = set_cursor(rows, cursor)
+        rows = rows[:ROLLUP_BATCH_SIZE]
+        cursor = get_cursor(rows) # also evaluates rows
+
+        for key in rows:
+            counts[key] = counts.get(key, 0) + 1
+
+        if len(rows) < ROLLUP_BATCH_SIZE:
+            break
+
+    for (label, source_model), count in counts.iteritems():
+        try:
+            # savepoint, so that an IntegrityError does not break an enclosing transaction
+            with transaction.atomic():
+                rollup, created = models.TaskRollup.objects.get_or_create(label=label, source_model=source_model, hour=hour,
+                                                                          defaults={'count': count})
+        except IntegrityError:
+            # created by an overlapping run since get_or_create looked it up
+            rollup, created = models.TaskRollup.objects.get(label=label, source_model=source_model, hour=hour), False
+
+        # rows of a past hour only ever get deleted, so a smaller count than rolled up before means that a previous run
+        # was interrupted while deleting them
+        if not created and rollup.count < count:
+            rollup.count = count
+            rollup.save()
+
+    return True
+
+def _delete(bucket, deadline):
+
+    deleted = 0
+
+    while time.time() < deadline:
+        pks = list(bucket.values_list('pk', flat=True)[:DELETE_BATCH_SIZE])
+        if not pks:
+            break
+
+        bucket.model.objects.filter(pk__in=pks).delete()
+        deleted += len(pks)
+
+    return deleted
+
+def compact_tasks(time_budget=RETENTION_TIME_BUDGET_SECONDS):
+    """
+    Rolls up and deletes task rows past retention until none are left or time_budget is spent.
+    Returns number of deleted rows.
+    """
+
+    deadline = time.time() + time_budget
+    task_model = models.get_task_model()
+
+    # only whole hours are compacted, so that an hour never gets rolled up while it still gets rows past retention
+    cutoff = _floor_hour(timezone.now() - timedelta(seconds=get_retention_seconds()))
+
+    deleted = 0
+
+    while time.time() < deadline:
+
+        oldest = list(task_model.objects.filter(created__lt=cutoff).order_by('created')[:1])
+        if not oldest:
+            break
+
+        hour = _floor_hour(oldest[0].created)
+        bucket = task_model.objects.filter(created__gte=hour, created__lt=hour + timedelta(hours=1))
+
+        if not _rollup(hour, bucket, deadline):
+            break
+        deleted += _delete(bucket, deadline)
+
+    if deleted:
+        logging.info('[denorm.retention.compact_tasks] rolled up and deleted %d task rows older than %s' % (deleted, cutoff))
+
+    return deleted
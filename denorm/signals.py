@@ -1,4 +1,21 @@
-
 from django.dispatch import Signal
 
-post_denorm = Signal(providing_args=['instance'])
\ No newline at end of file
+post_denorm = Signal(providing_args=['instance'])
+
+#
+# instrumentation signals of the denorm pipeline, sent per source and target model pair.
+# sender is the target model, source_model is the source model, and lag is seconds since the earliest merged source save.
+#
+
+# a pull task was added for a source save
+denorm_enqueued = Signal(providing_args=['source_model'])
+
+# merged pull tasks were dispatched to a strategy
+denorm_dispatched = Signal(providing_args=['source_model', 'strategy', 'merged_tasks', 'lag'])
+
+# a page of target instances was written by the cursor strategy. of its instances, skipped ones already held the denorm
+# values and were not written.
+denorm_page_written = Signal(providing_args=['source_model', 'instances', 'skipped', 'duration'])
+
+# the last target instance of a cursor chain or mapreduce job was written. duration is None if unknown.
+denorm_completed = Signal(providing_args=['source_model', 'instances', 'skipped', 'lag', 'duration'])
@@ -0,0 +1,198 @@
+#
+# Identity map of source instances for the signal receivers of target saves. While a source cache is active in the
+# current thread, target saves look up the sources they denormalize in it before querying them, so that e.g. an import
+# of many targets that point at the same few sources loads each source only once. The cache holds up to
+# settings.DENORM_SOURCE_CACHE_SIZE (1000) instances, and evicts the least recently used ones first. Source saves
+# replace their cached instance, so that targets saved after them get their new values.
+#
+# Activate a cache for each request with DenormSourceCacheMiddleware, or around any block of code with caching():
+#
+#   with source_cache.caching():
+#       denorm.prefetch_sources(targets)
+#       for target in targets:
+#           target.save()
+#
+# prefetch_sources() loads the sources of many target instances with one in_bulk call per source model. It also sets
+# the related instances of scalar sources on the targets, so it saves queries even without an active cache.
+#
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import local
+
+from django.conf import settings
+
+from denorm import core
+
+SOURCE_CACHE_SIZE = getattr(settings, 'DENORM_SOURCE_CACHE_SIZE', 1000)
+
+_thread_locals = local()
+
+class _SourceCache(object):
+
+    def __init__(self, max_size):
+        self.depth = 0
+        self.max_size = max_size
+        self.instances = OrderedDict() # (source model, pk) => instance, least recently used first
+
+    def get(self, source_model, pk):
+
+        instance = self.instances.pop((source_model, pk), None)
+        if instance is not None:
+            self.instances[(source_model, pk)] = instance
+
+        return instance
+
+    def add(self, source_model, instances):
+
+        for instance in instances:
+            self.instances.pop((source_model, instance.pk), None)
+            self.instances[(source_model, instance.pk)] = instance
+
+        while len(self.instances) > self.max_size:
+            self.instances.popitem(last=False)
+
+def _get_cache():
+    return getattr(_thread_locals, 'cache', None)
+
+def begin(max_size=None):
+    """
+    Starts caching source instances in the current thread. Calls may be nested, and only the outermost end() clears.
+    """
+
+    cache = _get_cache()
+    if cache is None:
+        cache = _thread_locals.cache = _SourceCache(max_size or SOURCE_CACHE_SIZE)
+
+    cache.depth += 1
+
+def end():
+    """
+    Ends caching, and clears the cache if this was the outermost one.
+    """
+
+    cache = _get_cache()
+    if cache is None:
+        return
+
+    cache.depth -= 1
+    if cache.depth <= 0:
+        _thread_locals.cache = None
+
+@contextmanager
+def caching(max_size=None):
+
+    begin(max_size)
+    try:
+        yield
+    finally:
+        end()
+
+def _to_pk(source_model, pk):
+
+    # denorm_data keys are strings, while cache keys are primary key values
+    return source_model._meta.pk.to_python(pk)
+
+def get_source(target_instance, source_plan):
+    """
+    Returns the source instance of a scalar storage source plan of target_instance, looking it up in the active cache
+    first. Raises ObjectDoesNotExist like the related field if the source does not exist.
+    """
+
+    cache = _get_cache()
+    source_pk = getattr(target_instance, source_plan.attname)
+
+    # a related instance that was assigned to the target, or loaded by it before, takes precedence
+    cache_name = target_instance._meta.get_field(source_plan.source).get_cache_name()
+
+    if cache is None or source_pk is None or hasattr(target_instance, cache_name):
+        return getattr(target_instance, source_plan.source)
+
+    source_instance = cache.get(source_plan.source_model, source_pk)
+
+    if source_instance is None:
+        source_instance = getattr(target_instance, source_plan.source)
+        cache.add(source_plan.source_model, [source_instance])
+
+    return source_instance
+
+def in_bulk(source_model, pks):
+    """
+    Returns source instances with the given primary keys keyed by primary key, like in_bulk, looking them up in the
+    active cache first.
+    """
+
+    cache = _get_cache()
+    if cache is None:
+        return source_model.objects.in_bulk(list(pks))
+
+    source_instances = {}
+    missing_pks = []
+
+    for pk in pks:
+        pk = _to_pk(source_model, pk)
+        source_instance = cache.get(source_model, pk)
+        if source_instance is None:
+            missing_pks.append(pk)
+        else:
+            source_instances[pk] = source_instance
+
+    if missing_pks:
+        loaded = source_model.objects.in_bulk(missing_pks)
+        cache.add(source_model, loaded.itervalues())
+        source_instances.update(loaded)
+
+    return source_instances
+
+def add(source_model, source_instance):
+    """
+    Replaces the cached instance of a saved source, if a cache is active.
+    """
+
+    cache = _get_cache()
+    if cache is not None and source_instance.pk is not None:
+        cache.add(source_model, [source_instance])
+
+def prefetch_sources(targets):
+    """
+    Loads the sources of registered target instances with one in_bulk call per source model. Sets the related instances
+    of scalar sources on the targets, and adds all loaded sources to the active cache, if any. Returns the loaded sources
+    keyed by (source model, primary key).
+    """
+
+    targets = list(targets)
+
+    # source model => pks to load, and scalar (target instance, source plan) pairs to set related instances of
+    source_pks = {}
+    related = []
+
+    for target_instance in targets:
+        target_plan = core.TARGET_PLANS.get(target_instance._meta.concrete_model)
+        if target_plan is None:
+            continue
+
+        for source_plan in target_plan.sources:
+            pks = source_pks.setdefault(source_plan.source_model, set())
+
+            if source_plan.storage == 'scalar':
+                source_pk = getattr(target_instance, source_plan.attname)
+                if source_pk is not None:
+                    pks.add(source_pk)
+                    related.append((target_instance, source_plan))
+            else:
+                pks.update(getattr(target_instance, source_plan.list_field_name) or [])
+
+    source_instances = {}
+
+    for source_model, pks in source_pks.iteritems():
+        if pks:
+            for pk, source_instance in in_bulk(source_model, pks).iteritems():
+                source_instances[(source_model, pk)] = source_instance
+
+    for target_instance, source_plan in related:
+        source_instance = source_instances.get((source_plan.source_model, getattr(target_instance, source_plan.attname)))
+        if source_instance is not None:
+            # assigning the related instance caches it on the target, like select_related
+            setattr(target_instance, source_plan.source, source_instance)
+
+    return source_instances
@@ -1,37 +1,319 @@
+import logging, sys, threading, time
 
-import json, logging
-
+from django.conf import settings
+from django.db import connections
 from djangoappengine.db.utils import get_cursor, set_cursor
-from google.appengine.ext import deferred
+from google.appengine.api import datastore
 
-from denorm import util
+import denorm
+from denorm import core, lanes, payloads, signals, util, versions
 
 ITEMS_PER_TASK = 100
 
-# TODO: implement shared_dict storage implementation for cursor strategy
-def denorm_instance(payload, cursor=None):
-    logging.info('[cursor.denorm_instance] payload %s, cursor %s' % (payload, cursor))
+# batch save depends on the djangoappengine db compiler customization also used by the mapreduce strategy
+BATCH_SAVE = getattr(settings, 'DENORM_CURSOR_BATCH_SAVE', False)
+
+# with a page budget, page sizes adapt to the measured seconds per target instance, so that a page takes about this
+# long to fetch and write. without one, pages have ITEMS_PER_TASK target instances. either way, page sizes are bounded
+# by the min_page_size and max_page_size options of the registration, if set.
+PAGE_BUDGET_SECONDS = getattr(settings, 'DENORM_CURSOR_PAGE_BUDGET_SECONDS', None)
+MIN_PAGE_SIZE = getattr(settings, 'DENORM_CURSOR_MIN_PAGE_SIZE', 10)
+MAX_PAGE_SIZE = getattr(settings, 'DENORM_CURSOR_MAX_PAGE_SIZE', 1000)
+
+# with a time budget, each task writes pages until the budget is used up, and only then defers the rest of the chain.
+# without one, each task writes a single page.
+TIME_BUDGET_SECONDS = getattr(settings, 'DENORM_CURSOR_TIME_BUDGET_SECONDS', None)
+
+# with a time budget, fetch the next page on a background thread while the current page is written
+PREFETCH = getattr(settings, 'DENORM_CURSOR_PREFETCH', False)
+
+# if set, load target instances with only() and save them with update_fields. instances loaded with only() are of a
+# deferred subclass, which is the sender of their pre_save and post_save signals, so receivers that applications connect
+# with sender=<target model> do not run for them.
+PARTIAL = getattr(settings, 'DENORM_CURSOR_PARTIAL', False)
+
+def is_partial(target_model):
+    """
+    Returns whether target instances of target_model are loaded with only() and saved with update_fields. post_denorm
+    receivers may set any field of the target, so targets with receivers are loaded and saved whole.
+    """
+
+    # a batch put writes whole entities, so they must be loaded whole
+    return PARTIAL and not BATCH_SAVE and not signals.post_denorm.has_listeners(target_model)
+
+def get_load_field_names(target_model, update_fields):
+    """
+    Returns names of the target fields that a fan-out loads: the fields it writes, and the fields that signal receivers
+    snapshot, which would otherwise be loaded one instance at a time.
+    """
+
+    field_names = set(update_fields)
+    field_names.update(key for key, attname in core.TARGET_PLANS[target_model].orig_source_attnames)
+
+    # target may in turn be a source of chained targets
+    source_plan = core.SOURCE_PLANS.get(target_model)
+    if source_plan:
+        field_names.update(source_plan.field_names)
+
+    return field_names
+
+def get_queryset(data, partial=False):
+    """
+    Returns queryset of all target instances of the source instance in payload data. If partial, and is_partial() for
+    the target model, only the fields that the fan-out needs are loaded.
+    """
 
-    data = json.loads(payload)
-    source_model = util.get_model_by_name(data['source_model'])
     target_model = util.get_model_by_name(data['target_model'])
-    related_field_name = data['related_field']
+    queryset = target_model.objects.filter(**{data['related_field']+'_id': data['instance_id']})
+
+    if partial and is_partial(target_model):
+        queryset = queryset.only(*get_load_field_names(target_model, data['fields']))
+
+    return queryset
+
+def _write_page(data, results, start):
+    """
+    Writes denorm values of payload data to a page of target instances, and defers the fan-outs of chained targets.
+    """
+
     fields = data['fields']
+    downstream = data.get('downstream')
+
+    # if instances were loaded with only(), their signals are sent by a deferred subclass of the target model
+    denorm.connect_deferred(results)
+
+    # skip targets that already hold the denorm values, e.g. of a retried page or a task merged into a later one
+    items = [item for item in results if not util.is_denormalized(item, fields)]
+
+    # (source field, target model) pairs of target instances, which are written by the downstream fan-outs below,
+    # rather than by a cascade of source saves
+    planned = set((field[len(spec['related_field']) + 1:], spec['target_model']) for spec in downstream or [] for field in spec['fields'])
+
+    for item in items:
+        item._denorm_values = fields # provide denorm values directly so that pre_save signal receiver does not lookup related field
+        if planned:
+            item._denorm_planned = planned
+
+    if BATCH_SAVE:
+        # save() still runs the signal receivers (and thus post_denorm) per item, but the puts are collected and
+        # executed as one multi-entity put for the whole page
+        if items:
+            datastore.Put([util.batch_save(item).entity for item in items])
+    elif is_partial(util.get_model_by_name(data['target_model'])):
+        # only write denormalized fields, so that concurrent edits of other fields are not overwritten
+        update_fields = fields.keys()
+
+        for item in items:
+            #print('[denorm_instance] denorm target instance %s' % item)
+            item.save(update_fields=update_fields)
+    else:
+        for item in items:
+            item.save()
+
+    # downstream fan-outs include skipped targets, whose own targets may not have been written yet
+    if downstream and results:
+        pks = [item.pk for item in results]
+
+        for spec in downstream:
+            downstream_payload = dict(spec,
+                                      source_model=data['target_model'],
+                                      created=data['created'],
+                                      first_created=data.get('first_created'),
+                                      strategy='cursor',
+                                      queue_name=data['queue_name'])
+
+            util.defer(denorm_downstream, payloads.dump(downstream_payload), pks, _queue=data['queue_name'])
+
+    skipped = len(results) - len(items)
+
+    signals.denorm_page_written.send(sender=util.get_model_by_name(data['target_model']),
+                                     source_model=util.get_model_by_name(data['source_model']),
+                                     instances=len(results), skipped=skipped, duration=time.time() - start)
+
+    return skipped
+
+def _send_completed(data, instances, skipped):
+
+    signals.denorm_completed.send(sender=util.get_model_by_name(data['target_model']),
+                                  source_model=util.get_model_by_name(data['source_model']),
+                                  instances=instances, skipped=skipped, lag=util.get_lag(data), duration=None)
+
+def get_page_size(data, item_seconds=None):
+    """
+    Returns the number of target instances to fetch for the next page, given the estimated seconds per instance.
+    """
+
+    if PAGE_BUDGET_SECONDS and item_seconds:
+        page_size = max(MIN_PAGE_SIZE, min(MAX_PAGE_SIZE, int(PAGE_BUDGET_SECONDS / item_seconds)))
+    else:
+        page_size = ITEMS_PER_TASK
+
+    return max(data.get('min_page_size') or 1, min(data.get('max_page_size') or page_size, page_size))
+
+def _estimate_item_seconds(item_seconds, page_seconds, page_size):
+    """
+    Returns the estimated seconds per target instance, updated with the duration of a page.
+    """
 
-    queryset = target_model.objects.filter(**{related_field_name+'_id': data['instance_id']})
+    if not page_size:
+        return item_seconds
+
+    page_item_seconds = page_seconds / page_size
+
+    # smooth estimate, so that a single slow or fast page does not swing page sizes
+    return page_item_seconds if item_seconds is None else (item_seconds + page_item_seconds) / 2
+
+def _fetch_page(data, pk_range, cursor, page_size):
+    """
+    Returns the page of target instances at cursor, and the cursor after it.
+    """
+
+    queryset = get_queryset(data, partial=True)
+    if pk_range:
+        # key range of a sharded_cursor shard. either end is open if None.
+        range_start, range_end = pk_range
+        if range_start is not None:
+            queryset = queryset.filter(pk__gte=range_start)
+        if range_end is not None:
+            queryset = queryset.filter(pk__lt=range_end)
     if cursor:
         queryset = set_cursor(queryset, cursor)
-    results = queryset[0:ITEMS_PER_TASK]
-    cursor = get_cursor(results)
+    results = queryset[0:page_size]
+    cursor = get_cursor(results) # also evaluates results
 
-    # TODO: batch save
-    for item in results:
-        #print('[denorm_instance] denorm target instance %s' % item)
+    # connect the deferred subclass of the page right away, so that the receivers are connected before the next page
+    # of the same subclass is prefetched on another thread, rather than while it loads
+    denorm.connect_deferred(results)
 
-        item._denorm_values = fields # provide denorm values directly so that pre_save signal receiver does not lookup related field
-        item.save()
+    return results, cursor
+
+def _prefetch(func, *args):
+    """
+    Calls func on a background thread. Returns a function that waits for and returns its result, or raises its error.
+    """
+
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = func(*args)
+        except Exception:
+            outcome['error'] = sys.exc_info()
+        finally:
+            # database connections are per thread
+            for connection in connections.all():
+                connection.close()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+
+    def get():
+        thread.join()
+        if 'error' in outcome:
+            raise outcome['error'][0], outcome['error'][1], outcome['error'][2]
+        return outcome['result']
+
+    return get
+
+# TODO: implement shared_dict storage implementation for cursor strategy
+def denorm_instance(payload, cursor=None, pk_range=None, instances=0, skipped=0, item_seconds=None):
+    logging.info('[cursor.denorm_instance] payload %s, cursor %s, pk_range %s, item seconds %s' % (payload, cursor, pk_range, item_seconds))
+
+    start = page_start = time.time()
+
+    # every task drops fields that a newer save of the source has queued a fan-out for since
+    data = versions.drop_superseded(payloads.load(payload))
+    if data is None:
+        logging.info('[cursor.denorm_instance] abort, because all fields are superseded by a newer version')
+        return
+
+    # large field values may be stored by reference
+    data = payloads.resolve(data)
+
+    # item_seconds is the estimate of seconds per target instance, carried forward along the chain
+    page_size = get_page_size(data, item_seconds)
+    results, cursor = _fetch_page(data, pk_range, cursor, page_size)
+    page_seconds = 0
+
+    while True:
+        more = len(results) == page_size
+
+        # continue with another page if it likely fits into the time budget, going by the previous page
+        next_page = more and TIME_BUDGET_SECONDS and time.time() + page_seconds - start < TIME_BUDGET_SECONDS
+
+        # the prefetched page is sized by the estimate before the current page
+        next_page_size = get_page_size(data, item_seconds)
+        prefetched = _prefetch(_fetch_page, data, pk_range, cursor, next_page_size) if next_page and PREFETCH else None
+
+        # instances and skipped count target instances processed and skipped by the whole chain so far
+        skipped += _write_page(data, results, page_start)
+        instances += len(results)
+
+        if not more:
+            if pk_range is None:
+                # sharded_cursor shards only process part of the fan-out
+                lanes.record_size(data, instances)
+            _send_completed(data, instances, skipped)
+            return
+
+        page_seconds = time.time() - page_start
+        page_start = time.time()
+
+        item_seconds = _estimate_item_seconds(item_seconds, page_seconds, len(results))
+
+        if not next_page or page_start - start >= TIME_BUDGET_SECONDS:
+            if prefetched:
+                # the rest of the chain continues after the page just written. just don't leave the thread running.
+                try:
+                    prefetched()
+                except Exception:
+                    pass
+            break
+
+        if not prefetched:
+            next_page_size = get_page_size(data, item_seconds)
+
+        page_size = next_page_size
+        results, cursor = prefetched() if prefetched else _fetch_page(data, pk_range, cursor, page_size)
+
+    # there are likely more items
+    logging.info('[denorm_instance] queue task with cursor %s' % cursor)
+    util.defer(denorm_instance, payload, cursor, pk_range, instances, skipped, item_seconds, _queue=data['queue_name'])
+
+def denorm_downstream(payload, instance_ids, cursor=None, instances=0, skipped=0):
+    """
+    Writes the target instances of several source instances, e.g. of a page of chained targets that were just written
+    by denorm_instance. Pages are filled across source instances in order, and cursor points into the first one.
+    """
+    logging.info('[cursor.denorm_downstream] payload %s, %d instance ids, cursor %s' % (payload, len(instance_ids), cursor))
+
+    start = time.time()
+
+    data = payloads.resolve(payloads.load(payload))
+    results = []
+
+    while instance_ids and len(results) < ITEMS_PER_TASK:
+
+        queryset = get_queryset(dict(data, instance_id=instance_ids[0]), partial=True)
+        if cursor:
+            queryset = set_cursor(queryset, cursor)
+
+        limit = ITEMS_PER_TASK - len(results)
+        page = queryset[0:limit]
+        page_cursor = get_cursor(page)
+        results.extend(page)
+
+        if len(page) == limit:
+            # there are likely more items of this source instance
+            cursor = page_cursor
+        else:
+            instance_ids = instance_ids[1:]
+            cursor = None
+
+    skipped += _write_page(data, results, start)
+    instances += len(results)
 
-    if len(results) == ITEMS_PER_TASK:
-        # there are likely more items
-        logging.info('[denorm_instance] queue task with cursor %s' % cursor)
-        deferred.defer(denorm_instance, payload, cursor, _queue=data['queue_name'])
\ No newline at end of file
+    if instance_ids:
+        util.defer(denorm_downstream, payload, instance_ids, cursor, instances, skipped, _queue=data['queue_name'])
+    else:
+        _send_completed(data, instances, skipped)
@@ -3,10 +3,9 @@ import json, logging
 
 from django.utils.timezone import now
 from djangoappengine.mapreduce.pipeline import _convert_model_to_string
-from inflector.inflector import Inflector
 from mapreduce import context, mapper_pipeline, operation as op, output_writers
 
-from denorm import util
+from denorm import core, lanes, payloads, signals, util, versions
 
 class NullOutputWriter(output_writers.OutputWriter):
 
@@ -59,22 +58,45 @@ class MapperPipeline(mapper_pipeline.MapperPipeline):
         logging.info(u'[MapperPipeline.finalized] job name %s denormalized %d instances in %d milliseconds'
                      % (self.args[0], counters.get('mapper-calls', 0), counters.get('mapper-walltime-ms', 0)))
 
-# FIXME: batch save depends on djangoappengine customization to db compiler
-def _batch_save(entity, save_params={}):
+        params = self.kwargs['params']
 
-    entity.batch_op_class = op.db.Put
-    entity.save(**save_params)
-    return entity.batch_op # batch op set in db compiler so it can be executed later
+        lanes.record_size(params, counters.get('mapper-calls', 0))
+
+        signals.denorm_completed.send(sender=util.get_model_by_name(params['target_model']),
+                                      source_model=util.get_model_by_name(params['source_model']),
+                                      instances=counters.get('mapper-calls', 0),
+                                      skipped=counters.get('denorm-skipped', 0), lag=util.get_lag(params),
+                                      duration=counters.get('mapper-walltime-ms', 0) / 1000.0)
 
 def denorm_entity_mapper(entity):
 
     ctx = context.get()
     params = ctx.mapreduce_spec.mapper.params
 
-    entity._denorm_values = params['denorm_values']
+    # large field values may be stored by reference. resolved values are kept in memory for the following calls.
+    denorm_values = payloads.resolve_values(params['denorm_values'])
+
+    # params carry the version and fields of the payload, so that each call can drop fields that a newer save of the
+    # source has queued a fan-out for since
+    superseded = versions.get_superseded_fields(params)
+    if superseded:
+        if len(superseded) == len(params['fields']):
+            yield op.counters.Increment('denorm-superseded')
+            return
+
+        # shared_dict entries are written whole, so their fields are only dropped together
+        if params['storage'] == 'scalar':
+            denorm_values = dict((field, value) for field, value in denorm_values.iteritems() if field not in superseded)
+
+    if util.is_denormalized(entity, denorm_values):
+        # e.g. target was already written by a retried shard, or by a task merged into a later one
+        yield op.counters.Increment('denorm-skipped')
+        return
+
+    entity._denorm_values = denorm_values
 
     # Instead of naive single save: entity.save(), do the following more efficient batch save:
-    yield _batch_save(entity)
+    yield util.batch_save(entity)
 
 def denorm_instance(payload):
     logging.info('[map_reduce.denorm_instance] payload %s' % json.dumps(payload))
@@ -92,7 +114,7 @@ def denorm_instance(payload):
         assert(storage == 'shared_dict')
 
         # will look up source primary key in target's list field
-        related_field_name_filter = Inflector().pluralize(related_field_name)
+        related_field_name_filter = core.TARGET_PLANS[target_model].get_source(related_field_name).list_field_name
 
         denorm_values = {
             'denorm_data': {
@@ -116,7 +138,17 @@ def denorm_instance(payload):
                 [related_field_name_filter, '=', payload['instance_id']],
             ],
             'denorm_values': denorm_values,
-            #'storage': storage,
+            'storage': storage,
+            # for version checks
+            'instance_id': payload['instance_id'],
+            'related_field': related_field_name,
+            'fields': fields,
+            'version': payload.get('version'),
+            # for instrumentation when pipeline is finalized
+            'source_model': payload['source_model'],
+            'target_model': payload['target_model'],
+            'created': payload['created'],
+            'first_created': payload.get('first_created'),
         },
         shards = payload['shards']
     )
@@ -0,0 +1,32 @@
+import logging
+
+from denorm import payloads, util, versions
+from denorm.strategies import cursor
+
+def denorm_instance(payload):
+    """
+    Splits target instances into key ranges of roughly equal size, and runs a cursor strategy chain per key range in
+    parallel. Each shard gets at least a full page of target instances.
+    """
+    logging.info('[sharded_cursor.denorm_instance] payload %s' % payload)
+
+    data = payloads.load(payload)
+
+    if versions.drop_superseded(data) is None:
+        logging.info('[sharded_cursor.denorm_instance] abort, because all fields are superseded by a newer version')
+        return
+
+    queryset = cursor.get_queryset(data)
+    count = queryset.count()
+
+    shards = max(1, min(data['shards'], (count + cursor.ITEMS_PER_TASK - 1) / cursor.ITEMS_PER_TASK))
+
+    # shard boundaries are the keys at evenly spaced offsets in key order. outer ranges are open ended, so that target
+    # instances added or removed in the meantime can't fall in between ranges.
+    keys = queryset.order_by('pk').values_list('pk', flat=True)
+    boundaries = [None] + [keys[count * i / shards] for i in xrange(1, shards)] + [None]
+
+    logging.info('[sharded_cursor.denorm_instance] split %d target instances into %d shards' % (count, shards))
+
+    for pk_range in zip(boundaries[:-1], boundaries[1:]):
+        util.defer(cursor.denorm_instance, payload, None, pk_range, _queue=data['queue_name'])
@@ -1,5 +1,5 @@
 
-import json, logging
+import logging, time
 
 from dateutil.parser import parse as parse_date
 from django.conf import settings
@@ -8,36 +8,159 @@ from django.utils import timezone
 from google.appengine.api import taskqueue
 from google.appengine.ext import deferred
 
-from .strategies import cursor, map_reduce
-from . import util
+from .strategies import cursor, map_reduce, sharded_cursor
+from . import exceptions, lanes, payloads, queues, retention, signals, util, versions
 
 # lease errors only retried up to a minute, because cron task runs every minute anyway
 LEASE_TASKS_MAX_ATTEMPTS = 3
 LEASE_TASKS_BACKOFF_SECONDS = 15 # this value will be doubled on every subsequent retry
+LEASE_SECONDS = 60
+# drain mode stops dispatching a leased batch this long before its lease expires, so that its tasks can still be deleted
+LEASE_MARGIN_SECONDS = 15
 TASK_MIN_AGE_SECONDS = 60 if not settings.DEBUG else 1
 
-def setup_denorm_task(attempts):
-    #print('[setup_denorm_task]')
+# strategies other than mapreduce run as deferred push tasks
+PUSH_STRATEGIES = {
+    'cursor': cursor.denorm_instance,
+    'sharded_cursor': sharded_cursor.denorm_instance,
+}
 
-    q = taskqueue.Queue('pull-denorm')
+# if set, setup_denorm_task drains the pull queue by leasing this many tasks per call and grouping them by tag in memory,
+# instead of leasing one task and then its duplicates by tag.
+DRAIN_BATCH_SIZE = getattr(settings, 'DENORM_DRAIN_BATCH_SIZE', None)
 
-    while True:
+# url and headers of the push tasks that drain mode builds, which must match those of deferred.defer
+DEFERRED_URL = getattr(settings, 'DENORM_DEFERRED_URL', '/_ah/queue/deferred')
+DEFERRED_HEADERS = {'Content-Type': 'application/octet-stream'}
+
+def _lease_tasks(q, attempts, max_tasks):
+    """
+    Leases up to max_tasks tasks. Returns None if leasing failed and a retry of setup_denorm_task has been queued.
+    """
+
+    try:
+        return q.lease(LEASE_SECONDS, max_tasks)
+    except exceptions.QueueTransientError as e:
+
+        if attempts >= LEASE_TASKS_MAX_ATTEMPTS:
+            logging.warning('[denorm.tasks.setup_denorm_task] lease raised QueueTransientError on attempt # %d. aborting' % attempts)
+            raise e
+
+        backoff = attempts * LEASE_TASKS_BACKOFF_SECONDS
+
+        logging.warning('[denorm.tasks.setup_denorm_task] lease raised QueueTransientError on attempt # %d. will queue next attempt in %d seconds' % (attempts, backoff))
+
+        deferred.defer(setup_denorm_task, attempts + 1, _countdown=backoff, _queue=queues.PUSH_QUEUE_NAME)
+
+        return None
+
+def merge_tasks(tag, tasks):
+    """
+    Merges the payload['fields'] of tasks sharing a tag, with newer tasks having priority.
+    Returns the payload and payload string of the merged task.
+    """
+
+    if len(tasks) == 1:
+        return payloads.load(tasks[0].payload), tasks[0].payload
+
+    # sort tasks from oldest to most recent
+    task_payloads = sorted(map(lambda t: payloads.load(t.payload), tasks), key=lambda p: p['created'])
+
+    # iterate tasks, and merge fields into most recent task, which is the prototype we will use for new task
+    payload = reduce(util.merge_payloads, task_payloads)
+    payload_string = payloads.dump(payload)
+
+    logging.info('[denorm.tasks.setup_denorm_task] merged %d tasks of tag %s into new payload %s' % (len(tasks), tag, payload_string))
+
+    return payload, payload_string
+
+def get_age_seconds(payload):
+    """
+    Returns the seconds since the newest source save merged into payload.
+    """
+
+    return (timezone.now() - parse_date(payload['created'])).total_seconds()
+
+def is_too_young(tag, payload, min_age_seconds=None):
+    """
+    Returns whether payload is younger than min_age_seconds, or TASK_MIN_AGE_SECONDS, and should not be dispatched yet.
+    """
+
+    age = get_age_seconds(payload)
+
+    if age < (TASK_MIN_AGE_SECONDS if min_age_seconds is None else min_age_seconds):
+        logging.info('[denorm.tasks.setup_denorm_task] task of tag %s with age %.1f seconds is too young' % (tag, age))
+        return True
 
-        try:
-            tasks = q.lease_tasks(60, 1)
-        except taskqueue.TransientError as e:
+    return False
 
-            if attempts >= LEASE_TASKS_MAX_ATTEMPTS:
-                logging.warning('[denorm.tasks.setup_denorm_task] lease_tasks raised TransientError on attempt # %d. aborting' % attempts)
-                raise e
+def drop_superseded(tag, payload, payload_string):
+    """
+    Drops fields of merged payload that a pull task of a newer source save has been added for since.
+    Returns the payload and payload string to dispatch, or None and None if all fields are superseded.
+    """
 
-            backoff = attempts * LEASE_TASKS_BACKOFF_SECONDS
+    kept = versions.drop_superseded(payload)
 
-            logging.warning('[denorm.tasks.setup_denorm_task] lease_tasks raised TransientError on attempt # %d. will queue next attempt in %d seconds' % (attempts, backoff))
+    if kept is None:
+        logging.info('[denorm.tasks.setup_denorm_task] all fields of tag %s are superseded by a newer version' % tag)
+        return None, None
 
-            # TODO: how do we configure queue name if we can't access task? specify in settings.conf?
-            deferred.defer(setup_denorm_task, attempts + 1, _countdown=backoff, _queue='denorm')
+    if kept is payload:
+        return payload, payload_string
 
+    return kept, payloads.dump(kept)
+
+def _route(router, payload, payload_string):
+    """
+    Routes the fan-out of payload to the push queue of its lane. Returns the payload and payload string to dispatch.
+    """
+
+    queue_name = router.get_queue_name(payload)
+    if queue_name == payload['queue_name']:
+        return payload, payload_string
+
+    payload = dict(payload, queue_name=queue_name)
+    return payload, payloads.dump(payload)
+
+def _deferred_task(func, *args):
+    """
+    Builds the push task deferred.defer would add, so that it can be added together with others in one call.
+    Returns None if the task is too large, in which case deferred.defer should be called directly.
+    """
+
+    pickled = deferred.serialize(func, *args)
+    if len(pickled) > taskqueue.MAX_PUSH_TASK_SIZE_BYTES:
+        return None
+
+    return taskqueue.Task(payload=pickled, url=DEFERRED_URL, headers=DEFERRED_HEADERS)
+
+def send_dispatched(payload, merged_tasks):
+    """
+    Sends denorm_dispatched for the fan-out of payload, merged from merged_tasks pull tasks.
+    """
+
+    signals.denorm_dispatched.send(sender=util.get_model_by_name(payload['target_model']),
+                                   source_model=util.get_model_by_name(payload['source_model']),
+                                   strategy=payload['strategy'], merged_tasks=merged_tasks, lag=util.get_lag(payload))
+
+def setup_denorm_task(attempts):
+    #print('[setup_denorm_task]')
+
+    q = queues.get_queue_backend()
+
+    # limits the target counts of lane routing in this run
+    router = lanes.Router()
+
+    if DRAIN_BATCH_SIZE:
+        _drain_denorm_tasks(q, attempts, router)
+        return
+
+    while True:
+
+        tasks = _lease_tasks(q, attempts, 1)
+
+        if tasks is None:
             return
 
         if not tasks:
@@ -47,61 +170,41 @@ def setup_denorm_task(attempts):
         task = tasks[0]
         tag = task.tag
 
-        payload_string = task.payload
-        payload = json.loads(payload_string)
-
-        #print('[setup_denorm_task] payload = %s' % payload)
-
         # lease all other tasks with this tag, merge the payload['fields'] together with newer tasks having priority,
         # and then delete the older tasks.
-        dupe_tasks = q.lease_tasks_by_tag(60, 100, tag) or []
+        dupe_tasks = q.lease_by_tag(LEASE_SECONDS, 100, tag)
 
         # in the end, we'll need to delete all these tasks
         tasks_to_delete = [task] + dupe_tasks
 
-        if dupe_tasks:
-
-            # sort tasks from oldest to most recent
-            dupe_tasks = map(lambda t: {'task': t, 'payload': json.loads(t.payload)}, dupe_tasks + [task])
-            dupe_tasks = sorted(dupe_tasks, key=lambda t: t['payload']['created'])
-
-            # iterate tasks, and merge fields into most recent task
-            fields = {}
-            for t in dupe_tasks:
-                fields.update(t['payload']['fields'])
-
-            # last (most recent) task is the prototype we will use for new task
-            task_data = dupe_tasks[-1]
-            task = task_data['task']
-            payload = task_data['payload']
-            payload['fields'] = fields
-            payload_string = util.dump_json(payload)
-
-            logging.info('[denorm.tasks.setup_denorm_task] merged %d tasks of tag %s into new payload %s' % (len(tasks_to_delete), tag, payload_string))
+        payload, payload_string = merge_tasks(tag, tasks_to_delete)
 
         #
         # if task is not old enough to execute:
         #    (a) if there were dupe tasks, then task payload fields is likely dirty. so we'll create a new task and delete this one.
         #    (b) else, ignore it and move one. the lease will expire on its own, and task will re-execute later.
         #
-        age = (timezone.now() - parse_date(payload['created']))
-
-        if age.total_seconds() < TASK_MIN_AGE_SECONDS:
+        if is_too_young(tag, payload):
             if dupe_tasks:
-                q.add(taskqueue.Task(payload=payload_string, tag=tag, method='PULL'))
-                q.delete_tasks(tasks_to_delete)
+                q.add([(tag, payload_string)])
+                q.delete(tasks_to_delete)
 
                 # note that this newly merged task will be iterated once again in the current cron job, which is unavoidable due to not using countdown.
                 # it's okay. next time, there'll be nothing to merge and then it will be ignored until lease expires.
 
-            logging.info('[denorm.tasks.setup_denorm_task] task of tag %s with age %s is too young' % (tag, age))
-
             continue
 
         #
         # if we reached here, then we're ready to execute task
         #
 
+        payload, payload_string = drop_superseded(tag, payload, payload_string)
+        if payload is None:
+            q.delete(tasks_to_delete)
+            continue
+
+        payload, payload_string = _route(router, payload, payload_string)
+
         strategy = payload['strategy']
 
         # TODO: use pipeline api
@@ -110,14 +213,106 @@ def setup_denorm_task(attempts):
         if strategy == 'mapreduce':
             map_reduce.denorm_instance(payload)
         else:
-            deferred.defer(cursor.denorm_instance, payload_string, _queue=payload['queue_name'])
+            deferred.defer(PUSH_STRATEGIES.get(strategy, cursor.denorm_instance), payload_string, _queue=payload['queue_name'])
 
         # delete this task, and any dupes. even though this task is not actually complete yet, we rely on push task integrity.
-        q.delete_tasks(tasks_to_delete)
+        q.delete(tasks_to_delete)
+
+        send_dispatched(payload, len(tasks_to_delete))
+
+def _drain_denorm_tasks(q, attempts, router):
+
+    batch_size = min(DRAIN_BATCH_SIZE, util.MAX_TASKS_PER_LEASE)
+
+    while True:
+
+        leased = time.time()
+        tasks = _lease_tasks(q, attempts, batch_size)
+
+        if tasks is None:
+            return
+
+        if not tasks:
+            logging.info('[denorm.tasks.setup_denorm_task] no tasks')
+            break
+
+        # group leased tasks by tag. duplicates of a tag that did not make it into this batch get merged in a later batch.
+        tag_tasks = {}
+        for task in tasks:
+            tag_tasks.setdefault(task.tag, []).append(task)
+
+        logging.info('[denorm.tasks.setup_denorm_task] leased %d tasks with %d distinct tags' % (len(tasks), len(tag_tasks)))
+
+        pull_tasks_to_add = []
+        push_tasks_to_add = {} # queue name => push tasks
+        tasks_to_delete = []
+        dispatched = [] # (payload, number of merged tasks)
+
+        for tag, dupe_tasks in tag_tasks.iteritems():
+
+            if time.time() - leased > LEASE_SECONDS - LEASE_MARGIN_SECONDS:
+                # leave the remaining tags leased. they are leased again once their lease expires.
+                logging.warning('[denorm.tasks.setup_denorm_task] lease of batch runs out, stop dispatching it')
+                break
+
+            payload, payload_string = merge_tasks(tag, dupe_tasks)
+
+            # same as serial mode: re-add young merged tasks, and leave young single tasks for their lease to expire
+            if is_too_young(tag, payload):
+                if len(dupe_tasks) > 1:
+                    pull_tasks_to_add.append((tag, payload_string))
+                    tasks_to_delete.extend(dupe_tasks)
+                continue
+
+            payload, payload_string = drop_superseded(tag, payload, payload_string)
+            if payload is None:
+                tasks_to_delete.extend(dupe_tasks)
+                continue
+
+            payload, payload_string = _route(router, payload, payload_string)
+
+            logging.info('[denorm.tasks.setup_denorm_task] queuing push task for tag %s' % tag)
+
+            if payload['strategy'] == 'mapreduce':
+                map_reduce.denorm_instance(payload)
+            else:
+                push_handler = PUSH_STRATEGIES.get(payload['strategy'], cursor.denorm_instance)
+                push_task = _deferred_task(push_handler, payload_string)
+                if push_task:
+                    push_tasks_to_add.setdefault(payload['queue_name'], []).append(push_task)
+                else:
+                    deferred.defer(push_handler, payload_string, _queue=payload['queue_name'])
+
+            tasks_to_delete.extend(dupe_tasks)
+            dispatched.append((payload, len(dupe_tasks)))
+
+        # add before deleting, so that a failure in between can only cause duplicate denormalization rather than lost one
+        if pull_tasks_to_add:
+            q.add(pull_tasks_to_add)
+
+        for queue_name, push_tasks in push_tasks_to_add.iteritems():
+            for chunk in util.chunks(push_tasks, util.MAX_TASKS_PER_ADD):
+                taskqueue.Queue(queue_name).add(chunk)
+
+        if tasks_to_delete:
+            q.delete(tasks_to_delete)
+
+        for payload, merged_tasks in dispatched:
+            send_dispatched(payload, merged_tasks)
+
+        if len(tasks) < batch_size:
+            # queue is drained. merged tasks we just re-added are too young anyway.
+            break
 
 @util.require_task_access
 def denorm_task_handler(request):
 
     setup_denorm_task(1)
 
-    return HttpResponse()
\ No newline at end of file
+    if retention.RETENTION:
+        retention.compact_tasks()
+
+    if payloads.PAYLOAD_REFERENCE_THRESHOLD:
+        payloads.delete_unreferenced()
+
+    return HttpResponse()
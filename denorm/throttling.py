@@ -0,0 +1,143 @@
+#
+# Throttle backends decide whether a denorm label has exceeded its configured throttles (e.g. '4/min'), and get told
+# whenever a Task row is written for a label so they can keep their own counters.
+#
+# The backend is chosen with settings.DENORM_THROTTLE_BACKEND. The default TaskCountThrottleBackend preserves the
+# original behavior of running one COUNT query on the Task table per throttle. The sliding window log backends keep,
+# per label, the timestamps of the most recent denorm tasks, so a check costs a single read.
+#
+
+from datetime import timedelta
+import threading, time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from mapreduce.util import handler_for_name
+
+from denorm import models, util
+
+THROTTLE_BACKEND = getattr(settings, 'DENORM_THROTTLE_BACKEND', 'denorm.throttling.TaskCountThrottleBackend')
+THROTTLE_CACHE_PREFIX = getattr(settings, 'DENORM_THROTTLE_CACHE_PREFIX', 'denorm_throttle')
+
+_backend = None
+
+def get_throttle_backend():
+    """
+    Returns the configured throttle backend instance.
+    """
+    global _backend
+    if _backend is None:
+        # handler_for_name instantiates the class for us
+        _backend = handler_for_name(THROTTLE_BACKEND)
+    return _backend
+
+class ThrottleBackend(object):
+
+    def is_throttled(self, label, throttles, pending=()):
+        """
+        Returns whether label exceeds any of throttles, counting the times of tasks that are pending, i.e. buffered but
+        not recorded yet, as well as recorded tasks. Pending times are in seconds since the epoch, oldest first.
+        """
+        raise NotImplementedError
+
+    def record(self, label, throttles):
+        pass
+
+class TaskCountThrottleBackend(ThrottleBackend):
+
+    def is_throttled(self, label, throttles, pending=()):
+
+        now = timezone.now()
+
+        for throttle in throttles:
+            num_requests, duration = util.parse_rate(throttle)
+
+            pending_requests = len([t for t in pending if t > time.time() - duration])
+
+            if models.get_task_model().objects.filter(label=label, created__gt=now - timedelta(seconds=duration)).count() + pending_requests >= num_requests:
+                return True
+
+        return False
+
+class SlidingWindowLogThrottleBackend(ThrottleBackend):
+    """
+    Keeps per label a sorted log of the timestamps of its most recent tasks. The log never needs to be longer than the
+    largest throttle count, because a throttle of N requests per period is exceeded exactly when the Nth most recent
+    timestamp falls inside the period.
+    """
+
+    def get_log(self, label):
+        raise NotImplementedError
+
+    def set_log(self, label, log, timeout):
+        raise NotImplementedError
+
+    def is_throttled(self, label, throttles, pending=()):
+
+        # pending tasks are newer than recorded ones
+        log = (self.get_log(label) or []) + list(pending)
+        if not log:
+            return False
+
+        now = time.time()
+
+        for throttle in throttles:
+            num_requests, duration = util.parse_rate(throttle)
+
+            if len(log) >= num_requests and log[-num_requests] > now - duration:
+                return True
+
+        return False
+
+    def record(self, label, throttles):
+
+        rates = [util.parse_rate(throttle) for throttle in throttles]
+        max_requests = max(num_requests for num_requests, duration in rates)
+        max_duration = max(duration for num_requests, duration in rates)
+
+        log = self.get_log(label) or []
+        log.append(time.time())
+
+        self.set_log(label, log[-max_requests:], max_duration)
+
+class LocalMemoryThrottleBackend(SlidingWindowLogThrottleBackend):
+    """
+    Keeps logs in process memory. Only accurate when a single process serves all saves, e.g. development server.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._logs = {}
+
+    def get_log(self, label):
+        with self._lock:
+            entry = self._logs.get(label)
+            if entry is None:
+                return None
+
+            log, expires = entry
+            if expires < time.time():
+                del self._logs[label]
+                return None
+
+            return list(log)
+
+    def set_log(self, label, log, timeout):
+        with self._lock:
+            self._logs[label] = (log, time.time() + timeout)
+
+class CacheThrottleBackend(SlidingWindowLogThrottleBackend):
+    """
+    Keeps logs in the default Django cache, e.g. memcache. Concurrent saves for the same label may occasionally
+    overwrite each other's timestamp, which errs on the side of not throttling.
+    """
+
+    def _key(self, label):
+        return '%s:%s' % (THROTTLE_CACHE_PREFIX, label)
+
+    def get_log(self, label):
+        return cache.get(self._key(label))
+
+    def set_log(self, label, log, timeout):
+        cache.set(self._key(label), log, timeout)
@@ -1,9 +1,10 @@
 
 from django.conf.urls import patterns, url
-import tasks
+import metrics, tasks
 
 urlpatterns = patterns('',
 
     url(r'^run-tasks$', tasks.denorm_task_handler),
+    url(r'^stats$', metrics.denorm_stats_handler),
 
 )
\ No newline at end of file
@@ -1,15 +1,65 @@
 
+from collections import OrderedDict
+from threading import local
 import json, logging
 
+from dateutil.parser import parse as parse_date
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db.models.loading import get_model
 from django.http import HttpResponseNotFound
-from google.appengine.api import taskqueue
+from django.utils import timezone
+from google.appengine.ext import deferred
 from json_field.fields import JSONEncoder
+from mapreduce import operation as op
+
+from denorm import core
+
+# taskqueue api limits
+MAX_TASKS_PER_ADD = 100
+MAX_TASKS_PER_LEASE = 1000
+
+_thread_locals = local()
+
+def defer(func, *args, **kwargs):
+    """
+    Defers a call of a strategy, e.g. the next page of a cursor chain, to a push queue. While collect_deferred is
+    active in the current thread, e.g. in a denorm worker, the call is collected instead.
+    """
+
+    calls = getattr(_thread_locals, 'deferred_calls', None)
+
+    if calls is None:
+        deferred.defer(func, *args, **kwargs)
+    else:
+        # drop task options, such as _queue and _countdown
+        calls.append((func, args, dict((name, value) for name, value in kwargs.iteritems() if not name.startswith('_'))))
+
+def collect_deferred(func, *args, **kwargs):
+    """
+    Calls func, and returns the (func, args, kwargs) calls it deferred with defer.
+    """
+
+    _thread_locals.deferred_calls = calls = []
+    try:
+        func(*args, **kwargs)
+    finally:
+        _thread_locals.deferred_calls = None
+
+    return calls
 
 def get_model_by_name(name):
 
-    return get_model(*name.split('.',1))
+    # registered models are resolved once at registration
+    model = core.MODELS_BY_NAME.get(name)
+    if model is not None:
+        return model
+
+    try:
+        return get_model(*name.split('.',1))
+    except LookupError:
+        # raised rather than returning None by django 1.7 and later
+        return None
 
 def get_model_name(model):
 
@@ -21,14 +71,89 @@ def get_model_name(model):
 def convert_func_to_string(func):
     return '%s.%s' % (func.__module__, func.__name__)
 
+# FIXME: batch save depends on djangoappengine customization to db compiler
+def batch_save(entity, save_params={}):
+
+    entity.batch_op_class = op.db.Put
+    entity.save(**save_params)
+    return entity.batch_op # batch op set in db compiler so it can be executed later
+
+def _merge_downstream(older, newer):
+
+    merged = OrderedDict(((spec['target_model'], spec['related_field']), spec) for spec in older or [])
+
+    for spec in newer or []:
+        key = (spec['target_model'], spec['related_field'])
+        if key in merged:
+            spec = merge_payloads(merged[key], spec)
+        merged[key] = spec
+
+    return merged.values()
+
+def merge_payloads(older, newer):
+    """
+    Returns newer payload, with the fields and downstream fan-outs only affected by older payload merged in.
+    """
+
+    merged = dict(newer, fields=dict(older['fields'], **newer['fields']))
+
+    if 'created' in older:
+        merged['first_created'] = older.get('first_created') or older['created']
+
+    downstream = _merge_downstream(older.get('downstream'), newer.get('downstream'))
+    if downstream:
+        merged['downstream'] = downstream
+
+    return merged
+
+def is_denormalized(instance, denorm_values):
+    """
+    Returns whether target instance already holds the denorm values, in which case writing them would not change it.
+    """
+
+    for field_name, value in denorm_values.iteritems():
+        if field_name == 'denorm_data':
+            denorm_data = getattr(instance, 'denorm_data', None) or {}
+
+            for list_field_name, list_field_denorm_values in value.iteritems():
+                source_denorm_data = denorm_data.get(list_field_name) or {}
+
+                # denorm_data keys are strings, b/c they are dumped into json string
+                for source_pk, source_denorm_values in list_field_denorm_values.iteritems():
+                    if source_denorm_data.get(str(source_pk)) != source_denorm_values:
+                        return False
+
+        else:
+            field = instance._meta.get_field(field_name)
+
+            # payload values were dumped into json, so convert them back before comparing
+            try:
+                if getattr(instance, field.attname) != field.to_python(value):
+                    return False
+            except (TypeError, ValidationError):
+                # e.g. naive and aware datetimes can't be compared. just write it.
+                return False
+
+    return True
+
+def get_lag(payload):
+    """
+    Returns seconds since the earliest source save merged into payload.
+    """
+
+    created = payload.get('first_created') or payload['created']
+    return (timezone.now() - parse_date(created)).total_seconds()
+
 def delete_tasks_by_tag(tag):
 
-    q = taskqueue.Queue('pull-denorm')
+    from denorm import queues
+
+    q = queues.get_queue_backend()
 
-    tasks = q.lease_tasks_by_tag(60, 100, tag)
+    tasks = q.lease_by_tag(60, 100, tag)
     if tasks:
         logging.info('[delete_tasks_by_tag] delete %d tasks with tag %s' % (len(tasks), tag))
-        q.delete_tasks(tasks)
+        q.delete(tasks)
 
 # parse_rate is used for throttling, and its implementation is copied from Django REST Framework throttling.
 def parse_rate(rate):
@@ -62,6 +187,11 @@ def require_task_access(func):
     return wrapper
 
 
+def chunks(items, size):
+
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
 def dump_json(data):
 
     return json.dumps(data, cls=JSONEncoder) # use special encoder to handle Decimal
\ No newline at end of file
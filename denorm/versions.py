@@ -0,0 +1,109 @@
+#
+# Version stamps of source saves. With settings.DENORM_VERSION_STAMPS = True, each source save gets a version from a
+# per-source instance counter in the Django cache, and its pull task payloads carry it. Once a pull task is added, its
+# version is stamped on each field it denormalizes, per source instance and target. Dispatch, cursor pages and mapper
+# calls then drop the fields that a pull task of a newer save has been added for, and abort when no fields are left, so
+# that only the latest fan-out of a hot source scans all of its targets.
+#
+# Stamps are only an optimization. If they get evicted from the cache, fan-outs simply run in full.
+#
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+VERSION_STAMPS = getattr(settings, 'DENORM_VERSION_STAMPS', False)
+VERSION_CACHE_PREFIX = getattr(settings, 'DENORM_VERSION_CACHE_PREFIX', 'denorm_version')
+VERSION_CACHE_TIMEOUT = getattr(settings, 'DENORM_VERSION_CACHE_TIMEOUT', 86400)
+
+def next_version(source_model_name, instance_id):
+    """
+    Returns a new version of the source instance that is higher than the versions returned before, or None if the
+    counter could not be incremented.
+    """
+
+    key = '%s:%s:%s' % (VERSION_CACHE_PREFIX, source_model_name, instance_id)
+
+    # if the counter expired or got evicted, it restarts from the current time in milliseconds, which is higher than
+    # versions returned before unless the source instance was saved more than once per millisecond on average
+    cache.add(key, int(time.time() * 1000), VERSION_CACHE_TIMEOUT)
+
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # evicted in between
+        return None
+
+def _field_keys(payload):
+    """
+    Returns stamp cache keys of the fields of payload, mapped to the field names.
+    """
+
+    prefix = '%s:%s:%s:%s:%s' % (VERSION_CACHE_PREFIX, payload['source_model'], payload['instance_id'],
+                                 payload['target_model'], payload['related_field'])
+
+    return dict(('%s:%s' % (prefix, field), field) for field in payload['fields'])
+
+def stamp(payloads):
+    """
+    Stamps the versions of added pull task payloads on the fields they denormalize.
+    """
+
+    stamps = {}
+
+    for payload in payloads:
+        if payload.get('version'):
+            for key in _field_keys(payload):
+                stamps[key] = payload['version']
+
+    if stamps:
+        cache.set_many(stamps, VERSION_CACHE_TIMEOUT)
+
+def get_superseded_fields(payload):
+    """
+    Returns names of the fields of payload that a pull task of a newer save of the source instance has been added for.
+    """
+
+    version = payload.get('version')
+    if not VERSION_STAMPS or not version:
+        return set()
+
+    keys = _field_keys(payload)
+    return set(keys[key] for key, stamp in cache.get_many(keys.keys()).iteritems() if stamp > version)
+
+def _drop_downstream_fields(downstream, fields):
+
+    kept = []
+
+    for spec in downstream:
+        # downstream field names are prefixed by their related field name
+        spec_fields = dict((field, value) for field, value in spec['fields'].iteritems()
+                           if field[len(spec['related_field']) + 1:] in fields)
+
+        if spec_fields:
+            spec = dict(spec, fields=spec_fields)
+            if spec.get('downstream'):
+                spec['downstream'] = _drop_downstream_fields(spec['downstream'], spec_fields)
+            kept.append(spec)
+
+    return kept
+
+def drop_superseded(payload):
+    """
+    Returns payload without superseded fields, or None if all of its fields are superseded.
+    """
+
+    superseded = get_superseded_fields(payload)
+    if not superseded:
+        return payload
+
+    fields = dict((field, value) for field, value in payload['fields'].iteritems() if field not in superseded)
+    if not fields:
+        return None
+
+    payload = dict(payload, fields=fields)
+    if payload.get('downstream'):
+        payload['downstream'] = _drop_downstream_fields(payload['downstream'], fields)
+
+    return payload
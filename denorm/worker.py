@@ -0,0 +1,258 @@
+#
+# Long-running denorm worker, an alternative to the cron handler for applications that run their own worker processes.
+# It leases pull tasks continuously, backing off while the queue is empty, merges them like setup_denorm_task, and runs
+# the pages of their fan-outs in a process or thread pool. Pages that a page defers, e.g. the next page of a cursor
+# chain or the key ranges of a sharded_cursor fan-out, are run in the pool as well rather than on the push queue.
+#
+# Pull tasks are only deleted once all pages of their fan-out have run, and their leases are extended until then, so
+# that long fan-outs are not leased and dispatched again while they run. Tasks of a tag whose fan-out is running stay
+# leased along with it, and are released once it completes, so that they are dispatched next. If a page fails, or the worker stops before a fan-out is complete, its pull
+# tasks are leased again when their lease expires, and the fan-out is retried.
+# On SIGTERM or SIGINT, the worker stops leasing and waits for the pages that are running. A second signal aborts them.
+#
+# Run it with `python manage.py denorm_worker`.
+#
+
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import logging, math, Queue, signal, time
+
+from django.db import close_old_connections, connections
+
+from denorm import exceptions, queues, tasks, util
+from denorm.strategies import cursor, map_reduce
+
+def _init_process():
+
+    # the worker process handles signals for the whole pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+def _run_page(func, args, kwargs):
+    """
+    Runs a page of a fan-out in the pool. Returns the calls it deferred, or None if it failed.
+    """
+
+    try:
+        return util.collect_deferred(func, *args, **kwargs)
+    except Exception:
+        logging.exception('[denorm.worker] %s failed' % func.__name__)
+        return None
+    finally:
+        close_old_connections()
+
+class _FanOut(object):
+
+    def __init__(self, tag, tasks):
+        self.tag = tag
+        self.tasks = tasks # pull tasks to delete once all pages have run
+        self.waiting = [] # pull tasks of the same tag leased while the fan-out runs
+        self.pages = 0 # pages in the pool
+        self.failed = False
+        self.abandoned = False
+
+class Worker(object):
+
+    def __init__(self, concurrency=4, threads=False, batch_size=100, lease_seconds=tasks.LEASE_SECONDS,
+                 min_age_seconds=1, max_backoff_seconds=5):
+        self.concurrency = concurrency
+        self.threads = threads
+        self.batch_size = min(batch_size, util.MAX_TASKS_PER_LEASE)
+        self.lease_seconds = lease_seconds
+        self.min_age_seconds = min_age_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+
+        self.backend = queues.get_queue_backend()
+        self.completed = Queue.Queue() # (fan-out, deferred calls) of pages that have run
+        self.pending = 0 # pages in the pool
+        self.in_flight = {} # tag => running fan-out
+        self.extended = time.time() # last time the leases of running fan-outs were extended
+        self.stopping = False
+        self.pool = None
+
+    def stop(self, signum=None, frame=None):
+
+        if self.stopping:
+            raise KeyboardInterrupt
+
+        logging.info('[denorm.worker] stopping once running pages have completed')
+        self.stopping = True
+
+    def run(self):
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        if self.threads:
+            self.pool = ThreadPool(self.concurrency)
+        else:
+            # forked pool processes must not share the database connections of this process
+            for connection in connections.all():
+                connection.close()
+            self.pool = Pool(self.concurrency, initializer=_init_process)
+
+        logging.info('[denorm.worker] started with %d %s' % (self.concurrency, 'threads' if self.threads else 'processes'))
+
+        try:
+            backoff = 0
+
+            while not self.stopping:
+                self._collect()
+                self._extend_leases()
+
+                if self.pending >= 2 * self.concurrency:
+                    # keep enough pages queued for the pool, but no more, so that leased tasks don't wait in memory
+                    self._collect(self.max_backoff_seconds)
+                    continue
+
+                if self._dispatch():
+                    backoff = 0
+                else:
+                    backoff = min(max(2 * backoff, 0.1), self.max_backoff_seconds)
+                    self._collect(backoff)
+
+            while self.pending:
+                self._collect(self.max_backoff_seconds)
+                self._extend_leases()
+
+        except KeyboardInterrupt:
+            logging.warning('[denorm.worker] aborting %d pages' % self.pending)
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        finally:
+            self.pool.join()
+
+        logging.info('[denorm.worker] stopped')
+
+    def _submit(self, fan_out, func, args, kwargs):
+
+        fan_out.pages += 1
+        self.pending += 1
+        self.pool.apply_async(_run_page, (func, args, kwargs), callback=lambda calls: self.completed.put((fan_out, calls)))
+
+    def _collect(self, timeout=None):
+        """
+        Handles pages that have run, waiting up to timeout seconds for one if there are none.
+        """
+
+        try:
+            fan_out, calls = self.completed.get(bool(timeout), timeout)
+            while True:
+                self._complete(fan_out, calls)
+                fan_out, calls = self.completed.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def _complete(self, fan_out, calls):
+
+        self.pending -= 1
+        fan_out.pages -= 1
+
+        if calls is None:
+            fan_out.failed = True
+        elif calls and self.stopping:
+            # don't start new pages. the fan-out is retried once its pull tasks are leased again.
+            fan_out.abandoned = True
+        elif not fan_out.failed:
+            for func, args, kwargs in calls:
+                self._submit(fan_out, func, args, kwargs)
+
+        if fan_out.pages > 0:
+            return
+
+        del self.in_flight[fan_out.tag]
+
+        if fan_out.failed or fan_out.abandoned:
+            # waiting tasks are retried along with the fan-out's own once their leases expire
+            logging.warning('[denorm.worker] fan-out of tag %s is incomplete. it is retried once its lease expires' % fan_out.tag)
+        else:
+            self.backend.delete(fan_out.tasks)
+
+            # release the leases of newer saves, so that they are dispatched right away
+            if fan_out.waiting:
+                self._modify_lease(fan_out.waiting, 0)
+
+    def _extend_leases(self):
+        """
+        Extends the leases of the pull tasks of running fan-outs, and of those waiting for them, once a third of the
+        lease duration has passed.
+        """
+
+        if not self.in_flight or time.time() - self.extended < self.lease_seconds / 3.0:
+            return
+
+        self.extended = time.time()
+
+        leased = [task for fan_out in self.in_flight.itervalues() for task in fan_out.tasks + fan_out.waiting]
+
+        if not self._modify_lease(leased, self.lease_seconds):
+            # retried on the next pass, which is still well within the leases
+            self.extended = 0
+
+    def _modify_lease(self, leased, lease_seconds):
+
+        try:
+            self.backend.modify_lease(leased, lease_seconds)
+        except exceptions.QueueTransientError as e:
+            logging.warning('[denorm.worker] modify_lease raised QueueTransientError: %s' % e)
+            return False
+
+        return True
+
+    def _dispatch(self):
+        """
+        Leases a batch of pull tasks, and submits the first pages of their merged fan-outs.
+        Returns the number of dispatched fan-outs.
+        """
+
+        try:
+            leased = self.backend.lease(self.lease_seconds, self.batch_size)
+        except exceptions.QueueTransientError as e:
+            logging.warning('[denorm.worker] lease raised QueueTransientError: %s' % e)
+            return 0
+
+        tag_tasks = {}
+        for task in leased:
+            tag_tasks.setdefault(task.tag, []).append(task)
+
+        tasks_to_delete = []
+        dispatched = 0
+
+        for tag, dupe_tasks in tag_tasks.iteritems():
+
+            if tag in self.in_flight:
+                # a newer save of a source whose fan-out is running. its lease is released once the fan-out completes.
+                self.in_flight[tag].waiting.extend(dupe_tasks)
+                continue
+
+            payload, payload_string = tasks.merge_tasks(tag, dupe_tasks)
+
+            if tasks.is_too_young(tag, payload, self.min_age_seconds):
+                # leave young tasks leased like setup_denorm_task does, but only until they are old enough, rather than
+                # for the whole lease. they are merged again when they are leased next.
+                remaining = self.min_age_seconds - tasks.get_age_seconds(payload)
+                self._modify_lease(dupe_tasks, int(math.ceil(max(1, remaining))))
+                continue
+
+            payload, payload_string = tasks.drop_superseded(tag, payload, payload_string)
+            if payload is None:
+                tasks_to_delete.extend(dupe_tasks)
+                continue
+
+            if payload['strategy'] == 'mapreduce':
+                # mapreduce jobs run on App Engine regardless
+                map_reduce.denorm_instance(payload)
+                tasks_to_delete.extend(dupe_tasks)
+            else:
+                handler = tasks.PUSH_STRATEGIES.get(payload['strategy'], cursor.denorm_instance)
+                fan_out = self.in_flight[tag] = _FanOut(tag, dupe_tasks)
+                self._submit(fan_out, handler, (payload_string,), {})
+
+            tasks.send_dispatched(payload, len(dupe_tasks))
+            dispatched += 1
+
+        if tasks_to_delete:
+            self.backend.delete(tasks_to_delete)
+
+        return dispatched